@@ -0,0 +1,36 @@
+"""Measure bulk insert throughput (keys/sec).
+
+    python benchmarks/bench_insert.py --rows 1000000 --backend leveldb
+"""
+import argparse
+import time
+
+from kvfile.kvfile_leveldb import KVFileLevelDB, CachedKVFileLevelDB
+from kvfile.kvfile_sqlite import KVFileSQLite, CachedKVFileSQLite
+
+BACKENDS = dict(
+    leveldb=KVFileLevelDB,
+    sqlite=KVFileSQLite,
+    cached_leveldb=CachedKVFileLevelDB,
+    cached_sqlite=CachedKVFileSQLite,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='leveldb')
+    args = parser.parse_args()
+
+    kv = BACKENDS[args.backend]()
+    start = time.perf_counter()
+    kv.insert((('%09d' % i, i) for i in range(args.rows)), batch_size=args.batch_size)
+    kv.close()
+    elapsed = time.perf_counter() - start
+    print('{}: {} rows in {:.2f}s, {:.0f} keys/sec'.format(
+        args.backend, args.rows, elapsed, args.rows / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Measure random read throughput with a shared store across threads.
+
+    python benchmarks/bench_threads.py --rows 100000 --backend cached_sqlite
+"""
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from kvfile.kvfile_leveldb import KVFileLevelDB, CachedKVFileLevelDB
+from kvfile.kvfile_sqlite import KVFileSQLite, CachedKVFileSQLite
+
+BACKENDS = dict(
+    leveldb=KVFileLevelDB,
+    sqlite=partial(KVFileSQLite, thread_safe=True),
+    cached_leveldb=partial(CachedKVFileLevelDB, thread_safe=True),
+    cached_sqlite=partial(CachedKVFileSQLite, thread_safe=True),
+)
+
+
+def reader(kv, keys, reads):
+    rnd = random.Random()
+    for _ in range(reads):
+        kv.get(rnd.choice(keys))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--reads', type=int, default=100000, help='reads per thread')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--cache-size', type=int, default=1000)
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='cached_sqlite')
+    args = parser.parse_args()
+
+    cls = BACKENDS[args.backend]
+    kv = cls(size=args.cache_size) if args.backend.startswith('cached') else cls()
+    keys = ['%09d' % i for i in range(args.rows)]
+    kv.insert((key, key) for key in keys)
+
+    for threads in args.threads:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            for future in [pool.submit(reader, kv, keys, args.reads) for _ in range(threads)]:
+                future.result()
+        elapsed = time.perf_counter() - start
+        print('{}: {} threads, {:.0f} reads/sec'.format(args.backend, threads, threads * args.reads / elapsed))
+    kv.close()
+
+
+if __name__ == '__main__':
+    main()
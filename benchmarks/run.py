@@ -0,0 +1,215 @@
+"""Benchmark suite: throughput of the storage backends, serializers and caches.
+
+Runs every combination of backend, serializer and dataset size, and writes the
+results as JSON, to be compared across commits:
+
+    python benchmarks/run.py --sizes 10k 100k 1M --output results.json
+    python benchmarks/run.py --compare before.json after.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+
+from kvfile.kvfile_leveldb import KVFileLevelDB, CachedKVFileLevelDB
+from kvfile.kvfile_sqlite import KVFileSQLite, CachedKVFileSQLite
+from kvfile.kvfile_log import KVFileLog, CachedKVFileLog
+from kvfile.serializer import PickleSerializer, JsonSerializer
+
+BACKENDS = dict(
+    leveldb=KVFileLevelDB,
+    sqlite=KVFileSQLite,
+    log=KVFileLog,
+    cached_leveldb=CachedKVFileLevelDB,
+    cached_sqlite=CachedKVFileSQLite,
+    cached_log=CachedKVFileLog,
+)
+SERIALIZERS = dict(
+    pickle=PickleSerializer,
+    json=JsonSerializer,
+)
+BENCHMARKS = ('insert', 'set', 'get', 'items')
+
+
+def parse_size(size: str) -> int:
+    multipliers = dict(k=10 ** 3, m=10 ** 6)
+    if size[-1].lower() in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1].lower()])
+    return int(size)
+
+
+def key(i):
+    return '%010d' % i
+
+
+def value(i):
+    return dict(id=i, name='item %d' % i, score=i / 7, tags=['a', 'b'])
+
+
+class Runner():
+
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+        self.tempdirs = []
+
+    def measure(self, name, ops, func, **extra):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        result = dict(self.combination, benchmark=name, ops=ops, seconds=elapsed,
+                      ops_per_sec=ops / elapsed if elapsed else None, **extra)
+        self.results.append(result)
+        print('{backend:>14} {serializer:>6} {size:>9} {benchmark:<24} {ops_per_sec:>12,.0f} ops/sec'.format(**result),
+              flush=True)
+
+    def open(self, backend, serializer):
+        cls = BACKENDS[backend]
+        if backend.startswith('cached'):
+            cls = partial(cls, size=self.args.cache_size)
+        tempdir = tempfile.TemporaryDirectory(dir=self.args.dir, prefix='kvfile-bench-')
+        self.tempdirs.append(tempdir)
+        location = os.path.join(tempdir.name, 'db')
+        return cls(serializer=SERIALIZERS[serializer](), location=location)
+
+    def run(self, backend, serializer, size):
+        args = self.args
+        self.combination = dict(backend=backend, serializer=serializer, size=size)
+        rnd = random.Random(args.seed)
+        ops = min(args.ops, size)
+        kv = None
+        try:
+            if 'insert' in args.benchmarks:
+                for batch_size in args.batch_sizes:
+                    if kv is not None:
+                        kv.close()
+                        self.tempdirs.pop().cleanup()
+                    kv = self.open(backend, serializer)
+                    self.measure('insert[batch_size={}]'.format(batch_size), size,
+                                 lambda: kv.insert(((key(i), value(i)) for i in range(size)), batch_size=batch_size),
+                                 batch_size=batch_size)
+            else:
+                kv = self.open(backend, serializer)
+                kv.insert(((key(i), value(i)) for i in range(size)), batch_size=max(args.batch_sizes))
+
+            sequential = list(range(ops))
+            shuffled = [rnd.randrange(size) for _ in range(ops)]
+            missing = [size + rnd.randrange(size) for _ in range(ops)]
+            mixed = [
+                i if rnd.random() < args.hit_ratio else size + i
+                for i in shuffled
+            ]
+
+            if 'set' in args.benchmarks:
+                self.measure('set[sequential]', ops, lambda: [kv.set(key(i), value(i)) for i in sequential])
+                self.measure('set[random]', ops, lambda: [kv.set(key(i), value(i)) for i in shuffled])
+            if 'get' in args.benchmarks:
+                self.measure('get[sequential]', ops, lambda: [kv.get(key(i)) for i in sequential])
+                self.measure('get[random]', ops, lambda: [kv.get(key(i)) for i in shuffled])
+                self.measure('get[missing]', ops, lambda: [kv.get(key(i), default=None) for i in missing])
+                self.measure('get[hit_ratio={}]'.format(args.hit_ratio), ops,
+                             lambda: [kv.get(key(i), default=None) for i in mixed],
+                             hit_ratio=args.hit_ratio)
+            if 'items' in args.benchmarks:
+                self.measure('items', size, lambda: sum(1 for _ in kv.items()))
+                self.measure('items[reverse]', size, lambda: sum(1 for _ in kv.items(reverse=True)))
+
+            if 'get' in args.benchmarks and backend.startswith('cached'):
+                # Cache hit ratio of random reads, measured last as metrics
+                # slow down all later operations
+                kv.enable_metrics()
+                for i in shuffled:
+                    kv.get(key(i))
+                counters = kv.stats()['counters']
+                hits, misses = counters.get('cache.hits', 0), counters.get('cache.misses', 0)
+                self.results.append(dict(self.combination, benchmark='cache_hit_ratio[random]',
+                                         ops=ops, hit_ratio=hits / (hits + misses)))
+        finally:
+            if kv is not None:
+                kv.close()
+            while self.tempdirs:
+                self.tempdirs.pop().cleanup()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before, after, threshold):
+    """Print the throughput change of every benchmark in both result files."""
+    def index(filename):
+        with open(filename) as f:
+            return {
+                (r['backend'], r['serializer'], r['size'], r['benchmark']): r
+                for r in json.load(f)['results'] if r.get('ops_per_sec')
+            }
+    before, after = index(before), index(after)
+    regressions = 0
+    for k in sorted(before.keys() & after.keys()):
+        ratio = after[k]['ops_per_sec'] / before[k]['ops_per_sec']
+        flag = ''
+        if ratio < 1 - threshold:
+            flag = '  <-- regression'
+            regressions += 1
+        print('{:>14} {:>6} {:>9} {:<24} {:>12,.0f} -> {:>12,.0f} {:+7.1%}{}'.format(
+            *k, before[k]['ops_per_sec'], after[k]['ops_per_sec'], ratio - 1, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', choices=sorted(BACKENDS), default=sorted(BACKENDS))
+    parser.add_argument('--serializers', nargs='+', choices=sorted(SERIALIZERS), default=sorted(SERIALIZERS))
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[10000, 100000],
+                        help='dataset sizes, e.g. 10k 1M 10M')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 1000, 10000],
+                        help='batch sizes for insert()')
+    parser.add_argument('--ops', type=int, default=100000, help='operations per set/get benchmark')
+    parser.add_argument('--hit-ratio', type=float, default=0.5,
+                        help='ratio of existing keys for the mixed get benchmark')
+    parser.add_argument('--cache-size', type=int, default=CachedKVFileLevelDB.DEFAULT_CACHE_SIZE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dir', help='directory for the benchmark stores')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two result files instead of running')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown reported as a regression when comparing')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    runner = Runner(args)
+    for size in args.sizes:
+        for backend in args.backends:
+            for serializer in args.serializers:
+                runner.run(backend, serializer, size)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(
+                commit=git_commit(),
+                date=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                python=sys.version,
+                platform=platform.platform(),
+                cpus=os.cpu_count(),
+                args={k: v for k, v in vars(args).items() if k not in ('compare', 'output')},
+                results=runner.results,
+            ), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,2 @@
-from .kvfile import KVFile
+from .kvfile import KVFile, open_kvfile
 from .cached import CachedKVFile
@@ -0,0 +1,151 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, List
+
+from .base import KVFileBase
+from .kvfile import open_kvfile
+
+_DELETED = object()
+
+
+class AsyncKVFile():
+    """
+    asyncio front-end for a KVFile store.
+
+    Backend I/O runs on a dedicated thread per store, so it never blocks the
+    event loop. Concurrent `get` calls are coalesced into a single batched
+    backend lookup, and values found in the LRU of a `CachedKVFile` are
+    returned without leaving the loop.
+    """
+
+    DEFAULT_CHUNK_SIZE = 1000
+
+    def __init__(self, kvfile: KVFileBase=None, chunk_size=DEFAULT_CHUNK_SIZE, **kw):
+        self.kv = kvfile if kvfile is not None else open_kvfile(**kw)
+        self.serializer = self.kv.serializer
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kvfile-io')
+        # Held by the I/O thread while it uses the store, the loop only
+        # peeks into the cache when it's free
+        self.lock = threading.Lock()
+        self._writes = {}
+        self._reads = {}
+        self._batch = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def _locked(self, func, *args):
+        with self.lock:
+            return func(*args)
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, self._locked, func, *args)
+
+    def _get_nowait(self, key: str):
+        """Value of key if known without I/O, None otherwise."""
+        if key in self._writes:
+            return self._writes[key]
+        cache = getattr(self.kv, 'cache', None)
+        if cache is not None and self.lock.acquire(blocking=False):
+            try:
+                if key in cache:
+                    return cache[key]
+                return self.kv.pending.get(key)
+            finally:
+                self.lock.release()
+
+    def _get_db(self, key: str) -> asyncio.Future:
+        future = self._reads.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._reads[key] = loop.create_future()
+            if not self._batch:
+                loop.call_soon(self._read_batch)
+            self._batch.append(key)
+        return future
+
+    def _read_batch(self):
+        keys, self._batch = self._batch, []
+        self._run(self.kv._get_db_many, keys).add_done_callback(
+            lambda result: self._resolve(keys, result)
+        )
+
+    def _resolve(self, keys: List[str], result: asyncio.Future):
+        futures = [self._reads.pop(key) for key in keys]
+        if result.exception() is not None:
+            for future in futures:
+                future.set_exception(result.exception())
+        else:
+            for future, value in zip(futures, result.result()):
+                future.set_result(value)
+
+    async def _get_raw(self, key: str) -> bytes:
+        ret = self._get_nowait(key)
+        if ret is None:
+            # Shielded, as other callers may be waiting on the same lookup
+            ret = await asyncio.shield(self._get_db(key))
+        return None if ret is _DELETED else ret
+
+    def _value(self, value: bytes, kw):
+        if value is None:
+            if 'default' in kw:
+                return kw['default']
+            raise KeyError()
+        return self.serializer.deserialize(value)
+
+    async def get(self, key: str, **kw) -> object:
+        assert not self.kv.closed
+        return self._value(await self._get_raw(self.kv._encode_key(key)), kw)
+
+    async def get_many(self, keys: Iterable[str], **kw) -> List[object]:
+        assert not self.kv.closed
+        values = await asyncio.gather(*[self._get_raw(key) for key in self.kv._encode_keys(list(keys))])
+        return [self._value(value, kw) for value in values]
+
+    async def _write(self, key: str, value, func, *args):
+        # Reads issued while the write is queued see the new value
+        self._writes[key] = value
+        try:
+            await self._run(func, key, *args)
+        finally:
+            if self._writes.get(key) is value:
+                del self._writes[key]
+
+    async def set(self, key: str, value: object):
+        assert not self.kv.closed
+        value = self.serializer.serialize(value)
+        await self._write(self.kv._encode_key(key), value, self.kv._set_db, value)
+
+    async def delete(self, key: str):
+        assert not self.kv.closed
+        await self._write(self.kv._encode_key(key), _DELETED, self.kv._del_db)
+
+    async def _chunks(self, iterator):
+        while True:
+            chunk = await self._run(lambda: list(islice(iterator, self.chunk_size)))
+            if not chunk:
+                break
+            yield chunk
+
+    async def items(self, **kw):
+        iterator = await self._run(lambda: self.kv._decode_items(self.kv._items_raw(**kw)))
+        async for chunk in self._chunks(iterator):
+            for key, value in chunk:
+                yield key, self.serializer.deserialize(value)
+
+    async def keys(self, **kw):
+        iterator = await self._run(lambda: self.kv.keys(**kw))
+        async for chunk in self._chunks(iterator):
+            for key in chunk:
+                yield key
+
+    async def close(self):
+        if not self.kv.closed:
+            await self._run(self.kv.close)
+        self.executor.shutdown()
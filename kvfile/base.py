@@ -1,19 +1,102 @@
 import os
+import weakref
 from collections import deque
-from typing import Iterator, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Tuple
 import tempfile
 
-from .serializer import DefaultSerializer
+from .external_sort import ExternalSorter
+from .key_codec import KeyCodecBase
+from .metrics import Metrics, MeasuredSerializer, instrumented_class
+from .serializer import DefaultSerializer, CompressedSerializer
 from .serializer_base import SerializerBase
+from .sorted_table import write_sorted_table
 
 KeyValueIterator = Iterator[Tuple[str, object]]
 KeySValueIterator = Iterator[Tuple[str, bytes]]
 
+
+def key_bytes(key) -> bytes:
+    """Keys as stored by the backends: typed keys are encoded already, str keys as utf8."""
+    return key if key.__class__ is bytes else key.encode('utf8')
+
+
+def prefix_stop(prefix: str) -> str:
+    """Smallest key greater than all keys starting with `prefix` (None if unbounded)."""
+    if isinstance(prefix, bytes):
+        prefix = prefix.rstrip(b'\xff')
+        if not prefix:
+            return None
+        return prefix[:-1] + bytes((prefix[-1] + 1,))
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return None
+    last = ord(prefix[-1]) + 1
+    if 0xD800 <= last <= 0xDFFF:
+        last = 0xE000
+    return prefix[:-1] + chr(last)
+
+
+def key_range(prefix: str=None, start: str=None, stop: str=None, prefix_end: str=None) -> Tuple[str, str]:
+    """
+    Narrow a [start, stop) key range to the keys starting with `prefix`,
+    which end before `prefix_end` (by default, prefix_stop(prefix)).
+    """
+    if prefix:
+        if start is None or start < prefix:
+            start = prefix
+        if prefix_end is None:
+            prefix_end = prefix_stop(prefix)
+        if prefix_end is not None and (stop is None or stop > prefix_end):
+            stop = prefix_end
+    return start, stop
+
+
+def in_range(key: str, start: str=None, stop: str=None) -> bool:
+    return (start is None or key >= start) and (stop is None or key < stop)
+
+
+def deserialize_chunk(serializer: SerializerBase, chunk: List[Tuple[str, bytes]]) -> List[Tuple[str, object]]:
+    return [(key, serializer.deserialize(value)) for key, value in chunk]
+
+
 class KVFileBase():
 
     DEFAULT_BATCH_SIZE = 1000
+    DEFAULT_CHUNK_SIZE = 1000
+    DEFAULT_SORT_MEMORY_LIMIT = 64 * 1024 * 1024
+    EXECUTORS = dict(process=ProcessPoolExecutor, thread=ThreadPoolExecutor)
+    DICTIONARY_META = 'compression_dictionary'
+    EXPORTED_META = (DICTIONARY_META,)
+    # Number of keys, maintained by the backends which support it
+    COUNT_META = 'count'
+    # Timed once metrics are enabled
+    TIMED_METHODS = ('get', 'get_many', 'set', 'delete', '_set_db_batch')
+
+    def __init__(self, serializer: SerializerBase=None, location=None, dictionary_samples=0, readonly=False,
+                 key_codec: KeyCodecBase=None):
+        # Read only stores can be opened by many processes at the same time
+        assert location is not None or not readonly, 'Read only stores require a location'
+        self.readonly = readonly
+        # Without a key codec keys are str, otherwise the backend gets
+        # them encoded (as bytes) and scans decode them
+        self.key_codec = key_codec
+        self.binary_keys = key_codec is not None
+        self._init_location(location)
+        self.serializer = serializer or DefaultSerializer()
+        # Train a compression dictionary on the first inserted values
+        self.dictionary_samples = dictionary_samples
+        if dictionary_samples and not isinstance(self.serializer, CompressedSerializer):
+            self.serializer = CompressedSerializer(self.serializer, threshold=16)
+        if isinstance(self.serializer, CompressedSerializer) and self.serializer.dictionary is None \
+                and self.serializer.dictionary_loader is None:
+            ref, name = weakref.ref(self), self.DICTIONARY_META
+            self.serializer.dictionary_loader = lambda: ref()._get_meta(name)
+        self.metrics = None
+        self.closed = False
 
-    def __init__(self, serializer: SerializerBase=None, location=None):
+    def _init_location(self, location):
         if location is None:
             self.tmpdir = tempfile.TemporaryDirectory()
             self.dirname = self.tmpdir.name
@@ -21,8 +104,6 @@ class KVFileBase():
         else:
             self.filename = location
             self.dirname = location
-        self.serializer = serializer or DefaultSerializer()
-        self.closed = False
 
     def close(self):
         if not self.closed:
@@ -34,6 +115,7 @@ class KVFileBase():
 
     def get(self, key: str, **kw) -> object:
         assert not self.closed
+        key = self._encode_key(key)
         ret = self._get_db(key)
         if ret is None:
             if 'default' in kw:
@@ -42,57 +124,274 @@ class KVFileBase():
         else:
             return self.serializer.deserialize(ret)
 
+    def get_raw(self, key: str, **kw) -> bytes:
+        assert not self.closed
+        key = self._encode_key(key)
+        ret = self._get_db(key)
+        if ret is None:
+            if 'default' in kw:
+                return kw['default']
+            raise KeyError()
+        return ret
+
+    def get_many(self, keys: Iterable[str], **kw) -> List[object]:
+        assert not self.closed
+        keys = list(keys)
+        ret = []
+        for key, value in zip(keys, self._get_db_many(self._encode_keys(keys))):
+            if value is None:
+                if 'default' in kw:
+                    ret.append(kw['default'])
+                    continue
+                raise KeyError(key)
+            ret.append(self.serializer.deserialize(value))
+        return ret
+
     def set(self, key: str, value: object):
         assert not self.closed
+        self._check_writable()
         value = self.serializer.serialize(value)
+        key = self._encode_key(key)
+        self._set_db(key, value)
+
+    def set_raw(self, key: str, value: bytes):
+        assert not self.closed
+        self._check_writable()
+        key = self._encode_key(key)
         self._set_db(key, value)
 
     def delete(self, key: str):
         assert not self.closed
+        self._check_writable()
+        key = self._encode_key(key)
         self._del_db(key)
 
-    def insert(self, key_value_iterator: KeyValueIterator, batch_size=DEFAULT_BATCH_SIZE):
+    def delete_many(self, keys: Iterable[str], batch_size=DEFAULT_BATCH_SIZE):
         assert not self.closed
-        deque(self.insert_generator(key_value_iterator, batch_size), maxlen=0)
+        self._check_writable()
+        keys = iter(keys)
+        for batch in iter(lambda: list(islice(keys, max(batch_size, 1))), []):
+            self._del_db_batch(self._encode_keys(batch))
 
-    def insert_generator(self, key_value_iterator: KeyValueIterator, batch_size=DEFAULT_BATCH_SIZE):
+    def delete_range(self, prefix=None, start=None, stop=None):
+        """Delete all keys in [start, stop) (and starting with prefix, if set)."""
         assert not self.closed
-        if batch_size == 1:
+        self._check_writable()
+        start, stop = self._key_range(prefix, start, stop)
+        self._del_db_range(start, stop)
+
+    def clear(self):
+        """Delete all keys. Store metadata, e.g. a compression dictionary, is kept."""
+        assert not self.closed
+        self._check_writable()
+        self._clear_db()
+
+    def __len__(self) -> int:
+        assert not self.closed
+        return self._count()
+
+    def insert(self, key_value_iterator: KeyValueIterator, batch_size=DEFAULT_BATCH_SIZE,
+               presort=False, memory_limit=DEFAULT_SORT_MEMORY_LIMIT):
+        assert not self.closed
+        deque(self.insert_generator(key_value_iterator, batch_size, presort, memory_limit), maxlen=0)
+
+    def insert_generator(self, key_value_iterator: KeyValueIterator, batch_size=DEFAULT_BATCH_SIZE,
+                         presort=False, memory_limit=DEFAULT_SORT_MEMORY_LIMIT):
+        assert not self.closed
+        self._check_writable()
+        if self._needs_dictionary():
+            key_value_iterator = self._train_dictionary(key_value_iterator)
+        if presort:
+            # Sort everything first (spilling to disk past memory_limit),
+            # so the backend receives the keys in order
+            sorter = ExternalSorter(self._scratch_dir(), memory_limit, binary_keys=self.binary_keys)
+            try:
+                for key, value in key_value_iterator:
+                    yield key, value
+                    sorter.add(self._encode_key(key), self.serializer.serialize(value))
+                self._insert_db(sorter.sorted(), batch_size)
+            finally:
+                sorter.close()
+        elif batch_size == 1:
             for key, value in key_value_iterator:
                 yield key, value
                 self.set(key, value)
         else:
             batch = []
+            encode = self.key_codec.encode if self.key_codec is not None else None
             for key, value in key_value_iterator:
                 yield key, value
                 value = self.serializer.serialize(value)
-                batch.append((key, value))
+                batch.append((key if encode is None else encode(key), value))
                 if len(batch) >= batch_size:
                     self._set_db_batch(batch)
                     batch.clear()
             if len(batch) > 0:
                 self._set_db_batch(batch)
 
-    def items(self, reverse=False) -> KeyValueIterator:
+    def insert_raw(self, key_value_iterator: KeySValueIterator, batch_size=DEFAULT_BATCH_SIZE):
         assert not self.closed
-        for key, value in self._db_items(reverse):
+        self._check_writable()
+        if self.key_codec is not None:
+            encode = self.key_codec.encode
+            key_value_iterator = ((encode(key), value) for key, value in key_value_iterator)
+        self._insert_db(key_value_iterator, batch_size)
+
+    def _insert_db(self, key_value_iterator: KeySValueIterator, batch_size=DEFAULT_BATCH_SIZE):
+        key_value_iterator = iter(key_value_iterator)
+        if batch_size == 1:
+            for key, value in key_value_iterator:
+                self._set_db(key, value)
+        else:
+            for batch in iter(lambda: list(islice(key_value_iterator, max(batch_size, 1))), []):
+                self._set_db_batch(batch)
+
+    def items_raw(self, reverse=False, prefix=None, start=None, stop=None, limit=None) -> KeySValueIterator:
+        return self._decode_items(self._items_raw(reverse, prefix, start, stop, limit))
+
+    def _items_raw(self, reverse=False, prefix=None, start=None, stop=None, limit=None) -> KeySValueIterator:
+        # Always yields bytes values, even where items_raw() returns views.
+        # Keys are not decoded
+        assert not self.closed
+        start, stop = self._key_range(prefix, start, stop)
+        items = self._db_items(reverse, start, stop)
+        if limit is not None:
+            items = islice(items, limit)
+        return items
+
+    def items(self, reverse=False, prefix=None, start=None, stop=None, limit=None,
+              workers=None, chunk_size=DEFAULT_CHUNK_SIZE, executor='process') -> KeyValueIterator:
+        items = self._decode_items(self._items_raw(reverse, prefix, start, stop, limit))
+        if workers:
+            yield from self._parallel_items(items, workers, chunk_size, executor)
+            return
+        for key, value in items:
             yield key, self.serializer.deserialize(value)
 
-    def keys(self, reverse=False) -> Iterator[str]:
+    def _parallel_items(self, items: KeySValueIterator, workers, chunk_size, executor) -> KeyValueIterator:
+        # Deserialize chunks of values in a pool, keeping at most two chunks
+        # per worker in flight and yielding them in order
+        chunks = iter(lambda: list(islice(items, chunk_size)), [])
+        pending = deque()
+        with self.EXECUTORS[executor](workers) as pool:
+            try:
+                for chunk in chunks:
+                    pending.append(pool.submit(deserialize_chunk, self.serializer, chunk))
+                    if len(pending) >= 2 * workers:
+                        yield from pending.popleft().result()
+                while pending:
+                    yield from pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def keys(self, reverse=False, prefix=None, start=None, stop=None, limit=None) -> Iterator[str]:
+        assert not self.closed
+        start, stop = self._key_range(prefix, start, stop)
+        keys = self._keys(reverse, start, stop)
+        if limit is not None:
+            keys = islice(keys, limit)
+        if self.key_codec is not None:
+            keys = map(self.key_codec.decode, keys)
+        return keys
+
+    def export(self, location, bloom_error_rate=None):
+        """
+        Freeze the contents of the store into an immutable sorted table file,
+        to be opened with `KVFileSortedTable`. Pass a bloom_error_rate
+        (e.g. 0.01) to also store a bloom filter, for faster misses.
+        """
         assert not self.closed
-        return self._keys(reverse)
+        meta = {}
+        for name in self.EXPORTED_META:
+            value = self._get_meta(name)
+            if value is not None:
+                meta[name] = value
+        write_sorted_table(location, self._items_raw(), meta, bloom_error_rate)
+
+    def enable_metrics(self, hook: Callable[[str, float], None]=None) -> Metrics:
+        """
+        Start collecting operation counts and latencies, see `stats()`.
+        Methods are only wrapped once this is called, so stores without
+        metrics don't pay for them.
+        """
+        assert self.metrics is None, 'Metrics are already enabled'
+        metrics = Metrics(hook)
+        self._instrument(metrics)
+        self.serializer = MeasuredSerializer(self.serializer, metrics)
+        return metrics
+
+    def stats(self) -> dict:
+        return self.metrics.stats() if self.metrics is not None else {}
+
+    def _instrument(self, metrics: Metrics):
+        self.metrics = metrics
+        self.__class__ = instrumented_class(type(self))
+
+    def _encode_key(self, key):
+        return key if self.key_codec is None else self.key_codec.encode(key)
+
+    def _encode_keys(self, keys: List) -> List:
+        return keys if self.key_codec is None else [self.key_codec.encode(key) for key in keys]
+
+    def _key_range(self, prefix=None, start=None, stop=None):
+        # key_range() over encoded keys
+        prefix_end = None
+        if self.key_codec is not None:
+            if prefix is not None:
+                encoded = self.key_codec.encode_prefix(prefix)
+                prefix, prefix_end = encoded, self.key_codec.prefix_stop(prefix, encoded)
+            start = None if start is None else self.key_codec.encode(start)
+            stop = None if stop is None else self.key_codec.encode(stop)
+        return key_range(prefix, start, stop, prefix_end)
+
+    def _decode_items(self, items: KeySValueIterator) -> KeyValueIterator:
+        if self.key_codec is None:
+            return items
+        decode = self.key_codec.decode
+        return ((decode(key), value) for key, value in items)
+
+    def _check_writable(self):
+        if self.readonly:
+            raise PermissionError('KVFile is opened read only')
+
+    def _scratch_dir(self):
+        if os.path.isdir(self.dirname):
+            return self.dirname
+        return os.path.dirname(os.path.abspath(self.filename))
+
+    def _needs_dictionary(self):
+        if not self.dictionary_samples:
+            return False
+        if self.serializer.dictionary_loader is not None:
+            self.serializer._load_dictionary()
+        return self.serializer.dictionary is None
+
+    def _train_dictionary(self, key_value_iterator: KeyValueIterator) -> KeyValueIterator:
+        key_value_iterator = iter(key_value_iterator)
+        samples = list(islice(key_value_iterator, self.dictionary_samples))
+        if samples:
+            dictionary = self.serializer.train_dictionary(
+                [self.serializer.serializer.serialize(value) for _, value in samples]
+            )
+            self._set_meta(self.DICTIONARY_META, dictionary)
+        yield from samples
+        yield from key_value_iterator
 
     # Implemented by subclasses:
     def _get_db(self, key: str) -> bytes:
         raise NotImplementedError()
 
+    def _get_db_many(self, keys: List[str]) -> List[bytes]:
+        return [self._get_db(key) for key in keys]
+
     def _set_db(self, key: str, value: bytes) -> None:
         raise NotImplementedError()
 
     def _del_db(self, key: str) -> None:
         raise NotImplementedError()
 
-    def _db_items(self, reverse=False) -> KeySValueIterator:
+    def _db_items(self, reverse=False, start=None, stop=None) -> KeySValueIterator:
         raise NotImplementedError()
 
     def _close_db(self):
@@ -102,5 +401,26 @@ class KVFileBase():
         for key, value in batch:
             self._set_db(key, value)
 
-    def _keys(self, reverse=False) -> Iterator[str]:
+    def _del_db_batch(self, keys: List[str]) -> None:
+        for key in keys:
+            self._del_db(key)
+
+    def _del_db_range(self, start=None, stop=None) -> None:
+        keys = self._keys(False, start, stop)
+        for batch in iter(lambda: list(islice(keys, self.DEFAULT_BATCH_SIZE)), []):
+            self._del_db_batch(batch)
+
+    def _clear_db(self) -> None:
+        self._del_db_range()
+
+    def _count(self) -> int:
+        return sum(1 for _ in self._keys())
+
+    def _keys(self, reverse=False, start=None, stop=None) -> Iterator[str]:
+        raise NotImplementedError()
+
+    def _get_meta(self, name: str) -> bytes:
+        raise NotImplementedError()
+
+    def _set_meta(self, name: str, value: bytes) -> None:
         raise NotImplementedError()
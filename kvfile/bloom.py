@@ -0,0 +1,58 @@
+import math
+from typing import Iterable
+from zlib import adler32, crc32
+
+# Seed for the second CRC32 making up the high half of the first hash
+SEED = 0x9747B28C
+
+
+class BloomFilter():
+    """
+    Fixed size bloom filter over byte strings.
+    Positions are derived from a pair of hashes (double hashing), built from
+    CRC32 and Adler-32, which are cheap to compute and stable across processes.
+    """
+
+    def __init__(self, capacity: int, error_rate=0.01, bits: bytearray=None, hashes: int=None):
+        capacity = max(capacity, 1)
+        if bits is None:
+            size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+            bits = bytearray((size + 7) // 8)
+        self.bits = bits
+        self.size = len(bits) * 8
+        self.hashes = hashes or max(int(round(self.size / capacity * math.log(2))), 1)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'BloomFilter':
+        return cls(1, bits=data[1:], hashes=data[0])
+
+    def to_bytes(self) -> bytes:
+        return bytes([self.hashes]) + bytes(self.bits)
+
+    def add(self, key: bytes):
+        h1 = crc32(key) << 32 | crc32(key, SEED)
+        h2 = adler32(key) | 1
+        bits, size = self.bits, self.size
+        for _ in range(self.hashes):
+            position = h1 % size
+            bits[position >> 3] |= 1 << (position & 7)
+            h1 += h2
+
+    def update(self, keys: Iterable[bytes]):
+        add = self.add
+        for key in keys:
+            add(key)
+
+    def __contains__(self, key: bytes) -> bool:
+        h1 = crc32(key) << 32 | crc32(key, SEED)
+        h2 = adler32(key) | 1
+        bits, size = self.bits, self.size
+        for _ in range(self.hashes):
+            position = h1 % size
+            if not bits[position >> 3] >> (position & 7) & 1:
+                return False
+            h1 += h2
+        return True
+
+    def clear(self):
+        self.bits[:] = bytes(len(self.bits))
@@ -1,87 +1,561 @@
-from typing import Iterator
+import heapq
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import partial
+from typing import Iterator, List, Tuple
+import threading
 import cachetools
 
+from .bloom import BloomFilter
+from .metrics import Metrics
 from .serializer_base import SerializerBase
-from .base import KVFileBase
+from .base import KVFileBase, KeySValueIterator, in_range, key_bytes
+from .key_codec import KeyCodecBase
 
-class DBWriteOnEvictionLRUCache(cachetools.LRUCache):
+cache_getitem = cachetools.Cache.__getitem__
 
-    def __init__(self, access_db, dirty_set, *args, **kw):
+
+def merge_overlay(overlay: List[Tuple[str, bytes]], items: KeySValueIterator, reverse=False) -> KeySValueIterator:
+    """Merge sorted (key, value) pairs with a sorted overlay, whose values win for equal keys."""
+    overlay = iter(overlay)
+    pending = next(overlay, None)
+    for item in items:
+        while pending is not None and (pending[0] > item[0] if reverse else pending[0] < item[0]):
+            yield pending
+            pending = next(overlay, None)
+        if pending is not None and pending[0] == item[0]:
+            yield pending
+            pending = next(overlay, None)
+        else:
+            yield item
+    if pending is not None:
+        yield pending
+        yield from overlay
+
+
+class TwoQCache(cachetools.Cache):
+    """
+    Scan resistant 2Q cache: new keys enter a FIFO queue (a quarter of the
+    cache), and only move to the main LRU queue when they're requested
+    again, either while still queued or soon after being evicted from it.
+    Keys recently evicted from the FIFO are remembered (without their
+    values) for that purpose. Keys read just once, e.g. by a long scan,
+    never displace the ones in the main queue.
+    """
+
+    IN_RATIO = 0.25
+
+    def __init__(self, maxsize, getsizeof=None):
+        cachetools.Cache.__init__(self, maxsize, getsizeof)
+        # Keys in the FIFO queue, with their sizes
+        self._in = OrderedDict()
+        self._in_size = 0
+        self._out = OrderedDict()
+        self._main = OrderedDict()
+
+    def __getitem__(self, key, cache_getitem=cachetools.Cache.__getitem__):
+        value = cache_getitem(self, key)
+        if key in self._main:
+            self._main.move_to_end(key)
+        elif key in self._in:
+            self._in_size -= self._in.pop(key)
+            self._main[key] = None
+        return value
+
+    def __setitem__(self, key, value, cache_setitem=cachetools.Cache.__setitem__):
+        cache_setitem(self, key, value)
+        size = self.getsizeof(value)
+        if key in self._main:
+            self._main.move_to_end(key)
+        elif key in self._in:
+            self._in_size += size - self._in[key]
+            self._in[key] = size
+        elif key in self._out:
+            del self._out[key]
+            self._main[key] = None
+        else:
+            self._in[key] = size
+            self._in_size += size
+
+    def __delitem__(self, key, cache_delitem=cachetools.Cache.__delitem__):
+        cache_delitem(self, key)
+        if key in self._in:
+            self._in_size -= self._in.pop(key)
+        else:
+            self._main.pop(key, None)
+
+    def popitem(self):
+        if self._in and (self._in_size > self.maxsize * self.IN_RATIO or not self._main):
+            key = next(iter(self._in))
+            value = cache_getitem(self, key)
+            del self[key]
+            self._out[key] = None
+            while len(self._out) > (len(self._in) + len(self._main)) // 2 + 1:
+                self._out.popitem(last=False)
+            return key, value
+        elif self._main:
+            key = next(iter(self._main))
+            value = cache_getitem(self, key)
+            del self[key]
+            return key, value
+        raise KeyError('%s is empty' % type(self).__name__)
+
+    def clear(self):
+        cachetools.Cache.clear(self)
+        self._in.clear()
+        self._in_size = 0
+        self._out.clear()
+        self._main.clear()
+
+
+class DBWriteOnEviction():
+    """
+    Mixin for cachetools caches: dirty entries leaving the cache are moved to
+    the pending buffer, which is written to the DB in batches.
+    """
+
+    metrics = None
+
+    def __init__(self, access_db, dirty_set, pending, *args, writeback_size=1, **kw):
         super().__init__(*args, **kw)
         self.access_db = access_db
         self.dirty_set = dirty_set
+        self.pending = pending
+        self.writeback_size = writeback_size
 
     def popitem(self):
         key, value = super().popitem()
+        if self.metrics is not None:
+            self.metrics.count('cache.evictions')
+        self._write_back(key, value)
+        return key, value
+
+    def _write_back(self, key, value):
         if key in self.dirty_set:
-            self.access_db()._set_db(key, value)
+            self.pending[key] = value
             self.dirty_set.discard(key)
-        return key, value
+            if len(self.pending) >= self.writeback_size:
+                self.write_pending()
+
+    def write_pending(self):
+        if self.pending:
+            if self.metrics is not None:
+                self.metrics.count('cache.flushes')
+                self.metrics.count('cache.writebacks', len(self.pending))
+            self.access_db()._set_db_batch(sorted(self.pending.items()))
+            self.pending.clear()
+
+    def fits(self, value: bytes) -> bool:
+        return self.getsizeof(value) <= self.maxsize
+
+    def expire(self, time=None):
+        return []
+
+
+class DBWriteOnEvictionLRUCache(DBWriteOnEviction, cachetools.LRUCache):
+    pass
+
+
+class DBWriteOnEvictionLFUCache(DBWriteOnEviction, cachetools.LFUCache):
+    pass
+
+
+class DBWriteOnEviction2QCache(DBWriteOnEviction, TwoQCache):
+    pass
+
+
+class DBWriteOnEvictionTTLCache(DBWriteOnEviction, cachetools.TTLCache):
+
+    # TTLCache drops expired entries without going through popitem()
+    def expire(self, time=None):
+        expired = cachetools.TTLCache.expire(self, time)
+        for key, value in expired:
+            self._write_back(key, value)
+        return expired
+
+    # Lookups freeze the clock, so that dirty entries expiring meanwhile are
+    # either found or written back (see CachedKVFile._get_db())
+    def __contains__(self, key):
+        with self.timer as now:
+            self.expire(now)
+            return cachetools.TTLCache.__contains__(self, key)
+
+    def get(self, key, default=None):
+        with self.timer as now:
+            self.expire(now)
+            if cachetools.TTLCache.__contains__(self, key):
+                return self[key]
+            return default
+
+
+class LazyDB():
+    """
+    Opens the backend of a CachedKVFile on first use. The cache writes back
+    through it rather than through the store, so that it doesn't keep the
+    store alive, and still reaches the backend while the store is being
+    garbage collected.
+    """
+
+    def __init__(self, open_db, lock):
+        self.open_db = open_db
+        self.lock = lock
+        self.db = None
+
+    def __call__(self):
+        if self.db is None:
+            with self.lock:
+                if self.db is None:
+                    self.db = self.open_db()
+        return self.db
+
+
+class CacheMetrics():
+    """Counts cache hits and misses of a CachedKVFile with metrics enabled."""
+
+    def _cached(self, key: str) -> bool:
+        with self.lock:
+            return key in self.cache or key in self.pending
+
+    def _get_db(self, key: str) -> bytes:
+        self.metrics.count('cache.hits' if self._cached(key) else 'cache.misses')
+        return super()._get_db(key)
+
+    def _get_db_many(self, keys: List[str]) -> List[bytes]:
+        hits = sum(1 for key in keys if self._cached(key))
+        self.metrics.count('cache.hits', hits)
+        self.metrics.count('cache.misses', len(keys) - hits)
+        return super()._get_db_many(keys)
 
 
 class CachedKVFile(KVFileBase):
 
     DEFAULT_CACHE_SIZE = 10240
+    # Dirty entries evicted from the cache are buffered and written to the DB
+    # in a single batch once this many have accumulated
+    DEFAULT_WRITEBACK_SIZE = 1000
+    # The bloom filter is rebuilt at twice the size when it fills up
+    DEFAULT_BLOOM_CAPACITY = 100000
+    METRICS_MIXIN = CacheMetrics
+    # Allowance of stale keys in the index of unwritten keys
+    UNWRITTEN_SLACK = 1000
+    CACHE_POLICIES = {
+        'lru': DBWriteOnEvictionLRUCache,
+        'lfu': DBWriteOnEvictionLFUCache,
+        '2q': DBWriteOnEviction2QCache,
+        'ttl': DBWriteOnEvictionTTLCache,
+    }
 
-    def __init__(self, kvfile_cls: KVFileBase=None, serializer: SerializerBase=None, location=None, size=DEFAULT_CACHE_SIZE):
-        super().__init__(serializer=serializer, location=location)
+    def __init__(self, kvfile_cls: KVFileBase=None, serializer: SerializerBase=None, location=None,
+                 size=DEFAULT_CACHE_SIZE, writeback_size=DEFAULT_WRITEBACK_SIZE, dictionary_samples=0,
+                 thread_safe=False, readonly=False, bloom_error_rate=None, policy='lru', max_bytes=None, ttl=None,
+                 key_codec: KeyCodecBase=None):
+        super().__init__(serializer=serializer, location=location, dictionary_samples=dictionary_samples,
+                         readonly=readonly, key_codec=key_codec)
+        # In thread safe mode the cache bookkeeping is done under a lock,
+        # while backend reads run outside of it (the backend must be thread
+        # safe as well). Each write bumps the generation, so that a value
+        # read from the backend isn't cached if it might be stale.
+        self.lock = threading.RLock() if thread_safe else nullcontext()
+        self.generation = 0
         self.dirty = set()
-        self.cache = DBWriteOnEvictionLRUCache(self.db, self.dirty, size)
+        self.pending = {}
+        # The cache holds the backend, but no reference back to self, so
+        # the store is closed (and flushed) as soon as it's unreferenced
         self.kvfile_cls = kvfile_cls
-        self._db = None
+        self.backend = LazyDB(partial(kvfile_cls, serializer=self.serializer, location=self.filename,
+                                      key_codec=self.key_codec), self.lock)
+        # With max_bytes, the cache is bounded by the total length of the
+        # (serialized) values it holds instead of by their number
+        cache_kw = dict(writeback_size=writeback_size)
+        if max_bytes is not None:
+            size = max_bytes
+            cache_kw['getsizeof'] = len
+        if policy == 'ttl':
+            assert ttl is not None, 'The ttl policy requires a ttl (in seconds)'
+            cache_kw['ttl'] = ttl
+        self.cache = self.CACHE_POLICIES[policy](self.backend, self.dirty, self.pending, size, **cache_kw)
         if location is not None:
-            self._db = self.db()
+            self.db()
+        # Sorted index of the dirty and pending keys, for merging them into
+        # scans, built on the first scan. It may hold stale and duplicate
+        # keys, and is rebuilt when too many have accumulated. New keys are
+        # collected in a smaller sorted list first.
+        self._unwritten_keys = None
+        self._unwritten_added = []
+        # Optional bloom filter over all keys, so that lookups of keys which
+        # were never written don't reach the backend. Deleted keys are only
+        # dropped from it by rebuild_bloom().
+        self.bloom = None
+        self.bloom_error_rate = bloom_error_rate
+        self.bloom_negatives = 0
+        self.bloom_false_positives = 0
+        if bloom_error_rate:
+            self.rebuild_bloom()
 
     def db(self):
-        if self._db is None:
-            self._db = self.kvfile_cls(serializer=self.serializer, location=self.filename)
-        return self._db
+        return self.backend()
+
+    @property
+    def _db(self):
+        # The backend, None until it's opened
+        return self.backend.db
 
     def _get_db(self, key: str) -> bytes:
-        if key in self.cache:
-            return self.cache[key]
-        else:
-            ret = self.db()._get_db(key)
+        with self.lock:
+            # A single lookup: with the ttl policy, an entry found by a
+            # separate containment check might have expired when it's read
+            ret = self.cache.get(key)
             if ret is not None:
+                return ret
+            elif key in self.pending:
+                return self.pending[key]
+            elif self._bloom_miss(key):
+                return None
+            generation = self.generation
+        ret = self.db()._get_db(key)
+        with self.lock:
+            if ret is None:
+                if self.bloom is not None:
+                    self.bloom_false_positives += 1
+            elif generation == self.generation and self.cache.fits(ret):
                 self.cache[key] = ret
-                self.dirty.discard(key)
-            return ret
+        return ret
+
+    def _get_db_many(self, keys: List[str]) -> List[bytes]:
+        found = {}
+        misses = []
+        with self.lock:
+            for key in keys:
+                if key in found:
+                    continue
+                value = self.cache.get(key)
+                if value is not None:
+                    found[key] = value
+                elif key in self.pending:
+                    found[key] = self.pending[key]
+                else:
+                    found[key] = None
+                    if not self._bloom_miss(key):
+                        misses.append(key)
+            generation = self.generation
+        if misses and self._db is not None:
+            values = self.db()._get_db_many(misses)
+            with self.lock:
+                for key, value in zip(misses, values):
+                    if value is None:
+                        if self.bloom is not None:
+                            self.bloom_false_positives += 1
+                    else:
+                        found[key] = value
+                        if generation == self.generation and self.cache.fits(value):
+                            self.cache[key] = value
+        return [found[key] for key in keys]
 
     def _set_db(self, key: str, value: bytes) -> None:
-        self.cache[key] = value
-        self.dirty.add(key)
+        with self.lock:
+            self.generation += 1
+            if self._unwritten_keys is not None and key not in self.dirty and key not in self.pending:
+                self._track_unwritten(key)
+            if self.cache.fits(value):
+                self.cache[key] = value
+                self.pending.pop(key, None)
+                self.dirty.add(key)
+            else:
+                # Too large to be cached, goes straight to the pending buffer
+                self.cache.pop(key, None)
+                self.dirty.discard(key)
+                self.pending[key] = value
+                if len(self.pending) >= self.cache.writeback_size:
+                    self.cache.write_pending()
+            if self.bloom is not None:
+                self.bloom.add(key_bytes(key))
+                self.bloom_keys += 1
+                if self.bloom_keys > self.bloom_capacity:
+                    self.rebuild_bloom()
 
     def _del_db(self, key: str) -> None:
-        self.cache.pop(key, None)
-        if self._db is not None:
-            self.db()._del_db(key)
-        self.dirty.discard(key)
+        with self.lock:
+            self.generation += 1
+            self.cache.pop(key, None)
+            self.pending.pop(key, None)
+            if self._db is not None:
+                self.db()._del_db(key)
+            self.dirty.discard(key)
 
-    def _keys(self, reverse=False) -> Iterator[str]:
-        if self._db is not None:
-            self.flush()
-            return self.db()._keys()
-        return sorted(self.cache.keys(), reverse=reverse)
+    def _del_db_batch(self, keys: List[str]) -> None:
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.cache.pop(key, None)
+                self.pending.pop(key, None)
+            if self._db is not None:
+                self.db()._del_db_batch(keys)
+            self.dirty.difference_update(keys)
 
-    def _close_db(self):
-        if self._db is not None:
+    def _del_db_range(self, start=None, stop=None) -> None:
+        with self.lock:
+            self.generation += 1
+            self.cache.expire()
+            for key in [key for key in self.cache.keys() if in_range(key, start, stop)]:
+                # Keys may expire (ttl policy) before they are popped
+                self.cache.pop(key, None)
+            for key in [key for key in self.pending if in_range(key, start, stop)]:
+                del self.pending[key]
+            if self._db is not None:
+                self.db()._del_db_range(start, stop)
+            self.dirty.difference_update([key for key in self.dirty if in_range(key, start, stop)])
+
+    def _clear_db(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.dirty.clear()
+            self.pending.clear()
+            self.cache.clear()
+            self._unwritten_keys = None
+            self._unwritten_added.clear()
+            if self._db is not None:
+                self.db()._clear_db()
+            if self.bloom is not None:
+                self.rebuild_bloom()
+
+    def _count(self) -> int:
+        # Unwritten keys may or may not exist in the backend already, so
+        # they're written first
+        with self.lock:
             self.flush()
-            self.db()._close_db()
-            self._db = None
+            return self.db()._count()
+
+    def _instrument(self, metrics: Metrics):
+        super()._instrument(metrics)
+        self.cache.metrics = metrics
+        # Backend operations are reported separately
+        self.db()._instrument(metrics.prefixed('backend.'))
+
+    def stats(self) -> dict:
+        ret = super().stats()
+        with self.lock:
+            ret['cache'] = dict(
+                size=len(self.cache), currsize=self.cache.currsize, maxsize=self.cache.maxsize,
+                dirty=len(self.dirty), pending=len(self.pending),
+            )
+        if self.bloom is not None:
+            ret['bloom'] = self.bloom_stats()
+        return ret
+
+    def _bloom_miss(self, key: str) -> bool:
+        if self.bloom is not None and key_bytes(key) not in self.bloom:
+            self.bloom_negatives += 1
+            return True
+        return False
+
+    def rebuild_bloom(self):
+        """
+        (Re)build the bloom filter from all stored keys, sized for twice
+        their number. Also prunes keys that were deleted since the last rebuild.
+        """
+        with self.lock:
+            keys = self.dirty | self.pending.keys()
+            count = len(keys)
+            if self._db is not None:
+                count += sum(1 for _ in self._db._keys())
+            capacity = max(2 * count, self.DEFAULT_BLOOM_CAPACITY)
+            bloom = BloomFilter(capacity, self.bloom_error_rate)
+            bloom.update(map(key_bytes, keys))
+            if self._db is not None:
+                bloom.update(map(key_bytes, self._db._keys()))
+            self.bloom, self.bloom_capacity, self.bloom_keys = bloom, capacity, count
+
+    def bloom_stats(self) -> dict:
+        """Lookups answered by the bloom filter, and ones it let through for missing keys."""
+        return dict(negatives=self.bloom_negatives, false_positives=self.bloom_false_positives)
 
-    def items(self, reverse=False):
+    def _get_meta(self, name: str) -> bytes:
         if self._db is not None:
-            self.flush()
-            yield from self.db().items(reverse)
+            return self.db()._get_meta(name)
+
+    def _set_meta(self, name: str, value: bytes) -> None:
+        self.db()._set_meta(name, value)
+
+    def _track_unwritten(self, key: str):
+        insort(self._unwritten_added, key)
+        if len(self._unwritten_added) > self.UNWRITTEN_SLACK:
+            keys = self._unwritten_keys
+            unwritten = len(self.dirty) + len(self.pending)
+            if len(keys) + len(self._unwritten_added) > 2 * unwritten + self.UNWRITTEN_SLACK:
+                # Mostly written back by now
+                keys[:] = sorted(self.dirty.union(self.pending))
+            else:
+                keys.extend(self._unwritten_added)
+                keys.sort()
+            self._unwritten_added.clear()
+
+    def _overlay(self, reverse=False, start=None, stop=None) -> List[Tuple[str, bytes]]:
+        # Sorted snapshot of the values in range which the backend doesn't
+        # have yet. Cache entries are read without touching their position
+        # in the cache, so that scans don't promote them
+        self.cache.expire()
+        if self._unwritten_keys is None:
+            self._unwritten_keys = sorted(self.dirty.union(self.pending))
+            self._unwritten_added.clear()
+        candidates = [
+            keys[
+                0 if start is None else bisect_left(keys, start):
+                len(keys) if stop is None else bisect_left(keys, stop)
+            ]
+            for keys in (self._unwritten_keys, self._unwritten_added)
+        ]
+        items = []
+        last = None
+        for key in heapq.merge(*candidates):
+            if key == last:
+                continue
+            last = key
+            if key in self.dirty:
+                items.append((key, cache_getitem(self.cache, key)))
+            elif key in self.pending:
+                items.append((key, self.pending[key]))
+        if reverse:
+            items.reverse()
+        return items
+
+    def _keys(self, reverse=False, start=None, stop=None) -> Iterator[str]:
+        with self.lock:
+            overlay = self._overlay(reverse, start, stop)
+            db = self._db
+        if db is None:
+            return iter([key for key, _ in overlay])
+        if not overlay:
+            return db._keys(reverse, start, stop)
+        return (key for key, _ in merge_overlay(overlay, ((key, None) for key in db._keys(reverse, start, stop)),
+                                                reverse))
+
+    def _db_items(self, reverse=False, start=None, stop=None) -> KeySValueIterator:
+        # Scans don't flush the cache: dirty values are merged into the
+        # backend's items instead
+        with self.lock:
+            overlay = self._overlay(reverse, start, stop)
+            db = self._db
+        if db is None:
+            yield from overlay
+        elif not overlay:
+            yield from db._db_items(reverse, start, stop)
         else:
-            for key in self.keys(reverse):
-                yield key, self.get(key)
+            yield from merge_overlay(overlay, db._db_items(reverse, start, stop), reverse)
+
+    def _close_db(self):
+        with self.lock:
+            if self._db is not None:
+                self.flush()
+                self.db()._close_db()
+                self.backend.db = None
 
     def flush(self):
-        if self.dirty:
-            self.db()._set_db_batch(
-                (k, v)
-                for k, v in self.cache.items()
-                if k in self.dirty
-            )
-            self.dirty.clear()
\ No newline at end of file
+        # Done under the lock, so that entries are never missing from both
+        # the cache and the backend
+        with self.lock:
+            self.cache.expire()
+            if self.dirty:
+                self.pending.update((k, cache_getitem(self.cache, k)) for k in self.dirty)
+                self.dirty.clear()
+            self.cache.write_pending()
\ No newline at end of file
@@ -0,0 +1,90 @@
+import heapq
+import os
+import struct
+import tempfile
+from typing import Iterator, Tuple
+
+RECORD_HEADER = struct.Struct('>II')
+# Approximate per-entry overhead of the in-memory buffer (dict slot, str and bytes objects)
+ENTRY_OVERHEAD = 150
+
+
+class ExternalSorter():
+    """
+    Sorts (key, value) pairs using a bounded amount of memory:
+    pairs are buffered until `memory_limit` bytes, then spilled as a
+    sorted run to a temporary file under `directory`.
+    Runs are k-way merged when reading, later duplicates win.
+    Keys are str, or bytes with `binary_keys`.
+    """
+
+    def __init__(self, directory=None, memory_limit=64 * 1024 * 1024, binary_keys=False):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.binary_keys = binary_keys
+        self.buffer = {}
+        self.buffer_size = 0
+        self.runs = []
+        self.tmpdir = None
+
+    def add(self, key: str, value: bytes):
+        self.buffer[key] = value
+        self.buffer_size += len(key) + len(value) + ENTRY_OVERHEAD
+        if self.buffer_size >= self.memory_limit:
+            self._spill()
+
+    def _spill(self):
+        if self.tmpdir is None:
+            self.tmpdir = tempfile.TemporaryDirectory(dir=self.directory, prefix='kvfile-sort-')
+        filename = os.path.join(self.tmpdir.name, 'run-{:06d}'.format(len(self.runs)))
+        with open(filename, 'wb') as run:
+            for key, value in sorted(self.buffer.items()):
+                if not self.binary_keys:
+                    key = key.encode('utf8')
+                run.write(RECORD_HEADER.pack(len(key), len(value)))
+                run.write(key)
+                run.write(value)
+        self.runs.append(filename)
+        self.buffer.clear()
+        self.buffer_size = 0
+
+    @staticmethod
+    def _read_run(filename, order, binary_keys=False):
+        # Yields (key, order, value) so that for equal keys the most recent
+        # run (lowest order) comes first in the merge
+        with open(filename, 'rb', buffering=1024 * 1024) as run:
+            while True:
+                header = run.read(RECORD_HEADER.size)
+                if not header:
+                    break
+                key_len, value_len = RECORD_HEADER.unpack(header)
+                key = run.read(key_len)
+                if not binary_keys:
+                    key = key.decode('utf8')
+                yield key, order, run.read(value_len)
+
+    def sorted(self) -> Iterator[Tuple[str, bytes]]:
+        try:
+            if not self.runs:
+                yield from sorted(self.buffer.items())
+                return
+            if self.buffer:
+                self._spill()
+            last_key = None
+            merged = heapq.merge(*[
+                self._read_run(filename, -i, self.binary_keys)
+                for i, filename in enumerate(self.runs)
+            ])
+            for key, _, value in merged:
+                if key != last_key:
+                    yield key, value
+                    last_key = key
+        finally:
+            self.close()
+
+    def close(self):
+        self.buffer.clear()
+        self.runs = []
+        if self.tmpdir is not None:
+            self.tmpdir.cleanup()
+            self.tmpdir = None
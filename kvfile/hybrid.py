@@ -0,0 +1,177 @@
+from bisect import bisect_left, insort
+from itertools import islice
+from typing import Iterator, List
+
+from .base import KVFileBase, KeySValueIterator
+from .external_sort import ENTRY_OVERHEAD
+from .key_codec import KeyCodecBase
+from .serializer_base import SerializerBase
+
+
+class HybridKVFile(KVFileBase):
+    """
+    Keeps all values in memory until they take more than `max_bytes`, then
+    bulk loads them into a `kvfile_cls` store and continues there.
+    Small temporary stores never touch the disk: the backend (and its
+    temporary directory) is only created when the budget is exceeded.
+    Stores with a location are opened in the backend right away.
+    """
+
+    DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+    SPILL_BATCH_SIZE = 10000
+
+    def __init__(self, kvfile_cls: KVFileBase=None, serializer: SerializerBase=None, location=None,
+                 max_bytes=DEFAULT_MAX_BYTES, dictionary_samples=0, readonly=False, key_codec: KeyCodecBase=None,
+                 **kw):
+        super().__init__(serializer=serializer, location=location, dictionary_samples=dictionary_samples,
+                         readonly=readonly, key_codec=key_codec)
+        if kvfile_cls is None:
+            # Imported here as kvfile.kvfile imports this module
+            from .kvfile import KVFile as kvfile_cls
+        self.kvfile_cls = kvfile_cls
+        self.backend_kw = kw
+        self.max_bytes = max_bytes
+        self.data = {}
+        self.meta = {}
+        self.size = 0
+        # Sorted keys for scans, built on the first scan and kept up to date
+        # until keys are deleted
+        self.sorted_keys = None
+        self.backend = None
+        if location is not None:
+            self._spill()
+
+    def _init_location(self, location):
+        # No temporary directory: the backend creates its own if it's needed
+        self.filename = self.dirname = location
+
+    def _scratch_dir(self):
+        if self.backend is not None:
+            return self.backend._scratch_dir()
+
+    def _spill(self):
+        self.backend = self.kvfile_cls(serializer=self.serializer, location=self.filename,
+                                       readonly=self.readonly, key_codec=self.key_codec, **self.backend_kw)
+        if self.metrics is not None:
+            self.backend._instrument(self.metrics.prefixed('backend.'))
+        for name, value in self.meta.items():
+            self.backend._set_meta(name, value)
+        keys = iter(sorted(self.data))
+        for batch in iter(lambda: list(islice(keys, self.SPILL_BATCH_SIZE)), []):
+            self.backend._set_db_batch([(key, self.data[key]) for key in batch])
+        self.data = self.meta = self.sorted_keys = None
+
+    def _instrument(self, metrics):
+        super()._instrument(metrics)
+        if self.backend is not None:
+            self.backend._instrument(metrics.prefixed('backend.'))
+
+    def _close_db(self):
+        if getattr(self, 'backend', None) is not None:
+            self.backend.close()
+
+    def _put(self, key: str, value: bytes):
+        old = self.data.get(key)
+        if old is None:
+            self.size += len(key) + len(value) + ENTRY_OVERHEAD
+            if self.sorted_keys is not None:
+                insort(self.sorted_keys, key)
+        else:
+            self.size += len(value) - len(old)
+        self.data[key] = value
+
+    def _get_db(self, key: str) -> bytes:
+        if self.backend is not None:
+            return self.backend._get_db(key)
+        return self.data.get(key)
+
+    def _get_db_many(self, keys: List[str]) -> List[bytes]:
+        if self.backend is not None:
+            return self.backend._get_db_many(keys)
+        return [self.data.get(key) for key in keys]
+
+    def _set_db(self, key: str, value: bytes) -> None:
+        if self.backend is not None:
+            return self.backend._set_db(key, value)
+        self._put(key, value)
+        if self.size > self.max_bytes:
+            self._spill()
+
+    def _set_db_batch(self, batch: KeySValueIterator) -> None:
+        if self.backend is not None:
+            return self.backend._set_db_batch(batch)
+        batch = iter(batch)
+        for key, value in batch:
+            self._put(key, value)
+            if self.size > self.max_bytes:
+                self._spill()
+                # The rest of the batch goes straight to the backend
+                self.backend._set_db_batch(batch)
+                return
+
+    def _del_db(self, key: str) -> None:
+        if self.backend is not None:
+            return self.backend._del_db(key)
+        value = self.data.pop(key, None)
+        if value is not None:
+            self.size -= len(key) + len(value) + ENTRY_OVERHEAD
+            self.sorted_keys = None
+
+    def _del_db_batch(self, keys: List[str]) -> None:
+        if self.backend is not None:
+            return self.backend._del_db_batch(keys)
+        for key in keys:
+            self._del_db(key)
+
+    def _del_db_range(self, start=None, stop=None) -> None:
+        if self.backend is not None:
+            return self.backend._del_db_range(start, stop)
+        self._del_db_batch(self._sorted_range(start, stop))
+
+    def _clear_db(self) -> None:
+        if self.backend is not None:
+            return self.backend._clear_db()
+        self.data.clear()
+        self.size = 0
+        self.sorted_keys = None
+
+    def _count(self) -> int:
+        if self.backend is not None:
+            return self.backend._count()
+        return len(self.data)
+
+    def _sorted_range(self, start=None, stop=None) -> List[str]:
+        if self.sorted_keys is None:
+            self.sorted_keys = sorted(self.data)
+        keys = self.sorted_keys
+        return keys[
+            0 if start is None else bisect_left(keys, start):
+            len(keys) if stop is None else bisect_left(keys, stop)
+        ]
+
+    def _keys(self, reverse=False, start=None, stop=None) -> Iterator[str]:
+        if self.backend is not None:
+            return self.backend._keys(reverse, start, stop)
+        keys = self._sorted_range(start, stop)
+        return reversed(keys) if reverse else iter(keys)
+
+    def _db_items(self, reverse=False, start=None, stop=None) -> KeySValueIterator:
+        if self.backend is not None:
+            return self.backend._db_items(reverse, start, stop)
+        # Keys deleted during the scan are skipped
+        data = self.data
+        return (
+            (key, data[key])
+            for key in self._keys(reverse, start, stop)
+            if key in data
+        )
+
+    def _get_meta(self, name: str) -> bytes:
+        if self.backend is not None:
+            return self.backend._get_meta(name)
+        return self.meta.get(name)
+
+    def _set_meta(self, name: str, value: bytes) -> None:
+        if self.backend is not None:
+            return self.backend._set_meta(name, value)
+        self.meta[name] = value
@@ -0,0 +1,216 @@
+import datetime
+
+# Type tags, which also order values of different types. All of them are
+# below 0xff, so encoded keys never start with it (see KVFileLevelDB)
+END = 0x00
+NONE = 0x01
+BYTES = 0x02
+STR = 0x03
+TUPLE = 0x05
+# Integers of up to 8 bytes are tagged INT_ZERO +/- their length,
+# longer ones are tagged NEG_INT / POS_INT and followed by their length
+NEG_INT = 0x0b
+INT_ZERO = 0x14
+POS_INT = 0x1d
+FALSE = 0x26
+TRUE = 0x27
+DATE = 0x30
+DATETIME = 0x31
+DATETIME_UTC = 0x32
+
+MAX_INT_BYTES = 0xfe
+DATETIME_MIN = datetime.datetime.min
+DATETIME_UTC_MIN = DATETIME_MIN.replace(tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+class KeyCodecBase():
+    """
+    Encodes keys into byte strings, which must sort like the keys do.
+    Stores opened with a key codec pass encoded keys to their backend,
+    and decode the keys they return.
+    """
+
+    def encode(self, key: object) -> bytes:
+        raise NotImplementedError()
+
+    def decode(self, key: bytes) -> object:
+        raise NotImplementedError()
+
+    def encode_prefix(self, prefix: object) -> bytes:
+        """Byte prefix shared by the encoded keys which start with `prefix`."""
+        return self.encode(prefix)
+
+    def prefix_stop(self, prefix: object, encoded: bytes) -> bytes:
+        """
+        Upper bound of the encoded keys which start with `prefix`, given its
+        encoded prefix. None for the smallest byte string greater than
+        all those starting with `encoded`.
+        """
+        return None
+
+
+def _escape(tag: bytes, data: bytes) -> bytes:
+    # Terminated by a 0x00 byte, 0x00 bytes in the data are escaped as
+    # 0x00 0xff (no tag is 0xff)
+    return tag + data.replace(b'\x00', b'\x00\xff') + b'\x00'
+
+
+# Headers of positive integers, by length
+INT_HEADERS = [bytes((INT_ZERO + length,)) for length in range(9)]
+
+
+def _encode_int(value: int) -> bytes:
+    if 0 <= value < 1 << 64:
+        length = (value.bit_length() + 7) // 8
+        return INT_HEADERS[length] + value.to_bytes(length, 'big')
+    if value > 0:
+        length = (value.bit_length() + 7) // 8
+        header = bytes((POS_INT, length))
+    else:
+        # One's complement, so that larger magnitudes sort first
+        length = ((-value).bit_length() + 7) // 8
+        value += (1 << 8 * length) - 1
+        if length <= 8:
+            return bytes((INT_ZERO - length,)) + value.to_bytes(length, 'big')
+        header = bytes((NEG_INT, 0xff - length))
+    if length > MAX_INT_BYTES:
+        raise ValueError('Integer key too large')
+    return header + value.to_bytes(length, 'big')
+
+
+def _encode_datetime(value: datetime.datetime) -> bytes:
+    if value.tzinfo is None:
+        return bytes((DATETIME,)) + ((value - DATETIME_MIN) // MICROSECOND).to_bytes(8, 'big')
+    return bytes((DATETIME_UTC,)) + ((value - DATETIME_UTC_MIN) // MICROSECOND).to_bytes(8, 'big')
+
+
+# By exact type first, then by isinstance() in this order (bool before
+# int, datetime before date)
+ENCODERS = {
+    str: lambda value: _escape(b'\x03', value.encode('utf8')),
+    bytes: lambda value: _escape(b'\x02', value),
+    bool: lambda value: b'\x27' if value else b'\x26',
+    int: _encode_int,
+    tuple: lambda value: b'\x05' + b''.join(map(encode_key, value)) + b'\x00',
+    datetime.datetime: _encode_datetime,
+    datetime.date: lambda value: bytes((DATE,)) + value.toordinal().to_bytes(4, 'big'),
+    type(None): lambda value: b'\x01',
+}
+
+
+def encode_key(key: object) -> bytes:
+    encoder = ENCODERS.get(key.__class__)
+    if encoder is None:
+        for cls, encoder in ENCODERS.items():
+            if isinstance(key, cls):
+                break
+        else:
+            raise TypeError('Unsupported key type: {}'.format(type(key).__name__))
+    return encoder(key)
+
+
+# Decoders take the data and the position after the tag, and return the
+# value and the position after it
+
+def _decode_bytes(data: bytes, pos: int):
+    end = data.index(b'\x00', pos)
+    if end + 1 == len(data) or data[end + 1] != 0xff:
+        return data[pos:end], end + 1
+    # Escaped 0x00 bytes
+    while end + 1 < len(data) and data[end + 1] == 0xff:
+        end = data.index(b'\x00', end + 2)
+    return data[pos:end].replace(b'\x00\xff', b'\x00'), end + 1
+
+
+def _decode_str(data: bytes, pos: int):
+    value, pos = _decode_bytes(data, pos)
+    return value.decode('utf8'), pos
+
+
+def _int_decoder(length: int, negative: bool):
+    complement = (1 << 8 * length) - 1 if negative else 0
+
+    def decode(data: bytes, pos: int):
+        end = pos + length
+        return int.from_bytes(data[pos:end], 'big') - complement, end
+    return decode
+
+
+def _decode_long_int(data: bytes, pos: int):
+    negative = data[pos - 1] == NEG_INT
+    length = 0xff - data[pos] if negative else data[pos]
+    return _int_decoder(length, negative)(data, pos + 1)
+
+
+def _decode_tuple(data: bytes, pos: int):
+    values = []
+    while data[pos] != END:
+        value, pos = DECODERS[data[pos]](data, pos + 1)
+        values.append(value)
+    return tuple(values), pos + 1
+
+
+def _decode_datetime(data: bytes, pos: int):
+    base = DATETIME_MIN if data[pos - 1] == DATETIME else DATETIME_UTC_MIN
+    return base + int.from_bytes(data[pos:pos + 8], 'big') * MICROSECOND, pos + 8
+
+
+def _invalid(data: bytes, pos: int):
+    raise ValueError('Invalid key tag 0x{:02x}'.format(data[pos - 1]))
+
+
+DECODERS = [_invalid] * 256
+DECODERS[NONE] = lambda data, pos: (None, pos)
+DECODERS[BYTES] = _decode_bytes
+DECODERS[STR] = _decode_str
+DECODERS[TUPLE] = _decode_tuple
+for length in range(1, 9):
+    DECODERS[INT_ZERO + length] = _int_decoder(length, False)
+    DECODERS[INT_ZERO - length] = _int_decoder(length, True)
+DECODERS[INT_ZERO] = lambda data, pos: (0, pos)
+DECODERS[NEG_INT] = DECODERS[POS_INT] = _decode_long_int
+DECODERS[FALSE] = lambda data, pos: (False, pos)
+DECODERS[TRUE] = lambda data, pos: (True, pos)
+DECODERS[DATE] = lambda data, pos: (datetime.date.fromordinal(int.from_bytes(data[pos:pos + 4], 'big')), pos + 4)
+DECODERS[DATETIME] = DECODERS[DATETIME_UTC] = _decode_datetime
+
+
+def decode_key(data: bytes, pos: int=0):
+    """Decode the key at `pos`, returns it with the position after it."""
+    return DECODERS[data[pos]](data, pos + 1)
+
+
+class TypedKeyCodec(KeyCodecBase):
+    """
+    Order preserving binary encoding of str, bytes, int, bool, None,
+    datetime and date keys, and of tuples of those.
+    Keys of the same type sort naturally (integers numerically, tuples
+    element by element), keys of different types sort by type.
+    Aware datetimes are stored in UTC, and decoded as UTC datetimes.
+    """
+
+    encode = staticmethod(encode_key)
+
+    def decode(self, key: bytes) -> object:
+        value, pos = DECODERS[key[0]](key, 1)
+        if pos != len(key):
+            raise ValueError('Invalid key {!r}'.format(key))
+        return value
+
+    def encode_prefix(self, prefix: object) -> bytes:
+        # Without the terminator, a string prefix matches all strings
+        # starting with it, and a tuple prefix all tuples starting with
+        # its elements
+        ret = encode_key(prefix)
+        if isinstance(prefix, (str, bytes, tuple)):
+            ret = ret[:-1]
+        return ret
+
+    def prefix_stop(self, prefix: object, encoded: bytes) -> bytes:
+        # A tuple prefix ends with the terminator of its last element, which
+        # is also how escaped 0x00 bytes start (0x00 0xff). The next element
+        # of the tuples starting with it has a tag below 0xff
+        if isinstance(prefix, tuple):
+            return encoded + b'\xff'
+        return None
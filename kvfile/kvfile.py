@@ -1,4 +1,33 @@
+from .hybrid import HybridKVFile
+from .kvfile_log import CachedKVFileLog
+from .kvfile_sqlite import CachedKVFileSQLite
+
+# Storage backends by name, see open_kvfile()
+BACKENDS = dict(
+    sqlite=CachedKVFileSQLite,
+    log=CachedKVFileLog,
+)
+
 try:
     from .kvfile_leveldb import CachedKVFileLevelDB as KVFile
+    BACKENDS['leveldb'] = KVFile
 except ImportError:
-    from .kvfile_sqlite import CachedKVFileSQLite as KVFile
+    KVFile = CachedKVFileSQLite
+
+
+def open_kvfile(backend: str=None, max_memory: int=None, **kw):
+    """
+    Open a store with an explicitly chosen backend ('leveldb', 'sqlite' or
+    'log'), or the default one (`KVFile`) if not set.
+    With `max_memory`, temporary stores are kept in memory until their data
+    takes more than `max_memory` bytes (see `HybridKVFile`).
+    """
+    if backend is None:
+        kvfile_cls = KVFile
+    elif backend in BACKENDS:
+        kvfile_cls = BACKENDS[backend]
+    else:
+        raise ValueError('Unknown backend {!r}, available backends: {}'.format(backend, ', '.join(sorted(BACKENDS))))
+    if max_memory is not None:
+        return HybridKVFile(kvfile_cls, max_bytes=max_memory, **kw)
+    return kvfile_cls(**kw)
@@ -1,56 +1,260 @@
-from typing import Iterator
+from functools import partial
+from itertools import takewhile
+from typing import Iterator, List
+import os
+import shutil
+import tempfile
+import threading
 import plyvel
-from .base import KVFileBase, KeySValueIterator
+from .base import KVFileBase, KeySValueIterator, key_bytes
 from .cached import CachedKVFile
+from .key_codec import KeyCodecBase
 from .serializer import SerializerBase
 
 class KVFileLevelDB(KVFileBase):
 
-    def __init__(self, serializer: SerializerBase=None, location=None):
-        super().__init__(serializer=serializer, location=location)
-        self.db = plyvel.DB(self.dirname, create_if_missing=True)
+    # UTF-8 encoded keys never contain 0xff, and typed keys never start
+    # with it, so metadata is stored under this prefix, after all data keys
+    META_PREFIX = b'\xff'
+
+    # Large batches are split into sub-batches of roughly this many bytes,
+    # so flushing a huge batch doesn't hold it all in one LevelDB WriteBatch
+    MAX_WRITE_BATCH_BYTES = 4 * 1024 * 1024
+
+    # With count_keys, writes check whether keys exist to maintain the key
+    # count. Bloom filters keep these checks cheap for new keys
+    BLOOM_FILTER_BITS = 10
+
+    def __init__(self, serializer: SerializerBase=None, location=None,
+                 sync=False, max_write_batch_bytes=MAX_WRITE_BATCH_BYTES, dictionary_samples=0, readonly=False,
+                 bloom_filter_bits=BLOOM_FILTER_BITS, count_keys=False, key_codec: KeyCodecBase=None):
+        super().__init__(serializer=serializer, location=location, dictionary_samples=dictionary_samples,
+                         readonly=readonly, key_codec=key_codec)
+        self.sync = sync
+        self.max_write_batch_bytes = max_write_batch_bytes
+        self.bloom_filter_bits = bloom_filter_bits
+        self.lock = threading.RLock()
+        if readonly:
+            self.db = plyvel.DB(self._snapshot(), bloom_filter_bits=bloom_filter_bits)
+        else:
+            self.db = self._open()
+        # The key count is kept in memory and saved on close. It's removed
+        # from the metadata on the first write, so that it's recounted if
+        # the store isn't closed properly (or was written without count_keys)
+        self.count_key = self.META_PREFIX + self.COUNT_META.encode('utf8')
+        count = self.db.get(self.count_key)
+        self.count_saved = count is not None
+        self.count = None
+        if count_keys:
+            self.count = int(count) if count is not None else sum(1 for _ in self._iterator(include_value=False))
+
+    def _open(self):
+        return plyvel.DB(self.dirname, create_if_missing=True, bloom_filter_bits=self.bloom_filter_bits)
+
+    def _snapshot(self):
+        # LevelDB allows a single process per DB directory. Read only stores
+        # open a private copy instead, in which the (immutable) table files
+        # are hard links, so the data isn't duplicated on disk.
+        # The store shouldn't be written to while being copied.
+        location = os.path.abspath(self.dirname)
+        self.snapshot_dir = tempfile.TemporaryDirectory(dir=os.path.dirname(location), prefix='kvfile-ro-')
+        for name in os.listdir(location):
+            if name == 'LOCK' or name.startswith('LOG'):
+                continue
+            source = os.path.join(location, name)
+            target = os.path.join(self.snapshot_dir.name, name)
+            if name.endswith(('.ldb', '.sst')):
+                try:
+                    os.link(source, target)
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(source, target)
+        return self.snapshot_dir.name
 
     def _close_db(self):
         if hasattr(self, 'db'):
+            if not self.readonly and self.count is not None and not self.count_saved:
+                self.db.put(self.count_key, str(self.count).encode('ascii'), sync=self.sync)
             self.db.close()
             del self.db
+        if hasattr(self, 'snapshot_dir'):
+            self.snapshot_dir.cleanup()
+            del self.snapshot_dir
 
     def _get_db(self, key: str) -> bytes:
-        return self.db.get(key.encode('utf8'))
+        return self.db.get(key_bytes(key))
+
+    def _get_db_many(self, keys: List[str]) -> List[bytes]:
+        # Look up in key order on a consistent snapshot, so consecutive reads
+        # hit neighbouring blocks
+        found = {}
+        with self.db.snapshot() as snapshot:
+            for key in sorted(set(keys)):
+                found[key] = snapshot.get(key_bytes(key))
+        return [found[key] for key in keys]
 
     def _set_db(self, key: str, value: bytes) -> None:
-        key = key.encode('utf8')
-        self.db.put(key, value)
+        key = key_bytes(key)
+        with self.lock:
+            self._unsave_count()
+            if self.count is not None and self.db.get(key) is None:
+                self.count += 1
+            self.db.put(key, value, sync=self.sync)
 
     def _del_db(self, key: str) -> None:
-        key = key.encode('utf8')
-        self.db.delete(key)
+        key = key_bytes(key)
+        with self.lock:
+            self._unsave_count()
+            if self.count is not None and self.db.get(key) is not None:
+                self.count -= 1
+            self.db.delete(key, sync=self.sync)
+
+    def _unsave_count(self):
+        if self.count_saved:
+            self.db.delete(self.count_key, sync=self.sync)
+            self.count_saved = False
 
-    def _keys(self, reverse=False) -> Iterator[str]:
-        it = self.db.iterator(reverse=reverse)
+    def _iterator(self, reverse=False, start=None, stop=None, **kw):
+        start = None if start is None else key_bytes(start)
+        stop = self.META_PREFIX if stop is None else key_bytes(stop)
+        if reverse and start is not None:
+            # plyvel's reverse iterators yield nothing when their range
+            # holds a single key, so the start bound is checked here
+            it = self.db.iterator(reverse=True, stop=stop, **kw)
+            if kw.get('include_value', True):
+                return takewhile(lambda item: item[0] >= start, it)
+            return takewhile(lambda key: key >= start, it)
+        return self.db.iterator(reverse=reverse, start=start, stop=stop, **kw)
+
+    def _keys(self, reverse=False, start=None, stop=None) -> Iterator[str]:
+        it = self._iterator(reverse, start, stop, include_value=False)
         try:
-            for key, _ in it:
-                yield key.decode('utf8')
+            if self.binary_keys:
+                yield from it
+            else:
+                for key in it:
+                    yield key.decode('utf8')
         finally:
             del it
 
-    def _db_items(self, reverse=False) -> KeySValueIterator:
-        it = self.db.iterator(reverse=reverse)
+    def _db_items(self, reverse=False, start=None, stop=None) -> KeySValueIterator:
+        it = self._iterator(reverse, start, stop)
         try:
-            for key, value in it:
-                yield (key.decode('utf8'), value)
+            if self.binary_keys:
+                yield from it
+            else:
+                for key, value in it:
+                    yield (key.decode('utf8'), value)
         finally:
             del it
 
+    def _get_meta(self, name: str) -> bytes:
+        return self.db.get(self.META_PREFIX + name.encode('utf8'))
+
+    def _set_meta(self, name: str, value: bytes) -> None:
+        self.db.put(self.META_PREFIX + name.encode('utf8'), value, sync=self.sync)
+
+    def _write_batches(self, operations) -> None:
+        # operations yields (key, value) pairs to put, or (key, None) to
+        # delete, and is consumed under the lock, as it updates the count
+        with self.lock:
+            self._unsave_count()
+            write_batch = self.db.write_batch(sync=self.sync)
+            pending = False
+            for key, value in operations:
+                if value is None:
+                    write_batch.delete(key)
+                else:
+                    write_batch.put(key, value)
+                pending = True
+                if write_batch.approximate_size() >= self.max_write_batch_bytes:
+                    write_batch.write()
+                    write_batch.clear()
+                    pending = False
+            if pending:
+                write_batch.write()
+            del write_batch
+
     def _set_db_batch(self, batch: KeySValueIterator) -> None:
-        write_batch = self.db.write_batch()
+        self._write_batches(self._puts(batch))
+
+    def _puts(self, batch: KeySValueIterator):
+        if self.count is None:
+            for key, value in batch:
+                yield key_bytes(key), value
+            return
+        # Keys after the last stored one are new, without looking them up.
+        # This makes appending sorted keys (e.g. a presorted insert) cheaper
+        it = self.db.iterator(reverse=True, stop=self.META_PREFIX, include_value=False)
+        last = next(it, None)
+        del it
+        added = set()
         for key, value in batch:
-            write_batch.put(key.encode('utf-8'), value)
-            write_batch.write()
-            write_batch.clear()
-        del write_batch
+            key = key_bytes(key)
+            if key not in added and (last is None or key > last or self.db.get(key) is None):
+                added.add(key)
+                self.count += 1
+            yield key, value
+
+    def _del_db_batch(self, keys: List[str]) -> None:
+        self._write_batches(self._deletes(key_bytes(key) for key in keys))
+
+    def _deletes(self, keys: Iterator[bytes], existing=False):
+        deleted = set()
+        for key in keys:
+            if self.count is None:
+                yield key, None
+                continue
+            if not existing:
+                if key in deleted or self.db.get(key) is None:
+                    continue
+                deleted.add(key)
+            self.count -= 1
+            yield key, None
+
+    def _del_db_range(self, start=None, stop=None) -> None:
+        # The iterator reads from an implicit snapshot, unaffected by the deletes
+        with self.lock:
+            it = self._iterator(False, start, stop, include_value=False)
+            try:
+                self._write_batches(self._deletes(it, existing=True))
+            finally:
+                del it
+
+    def _clear_db(self) -> None:
+        # Recreate the database from scratch, keeping the metadata
+        with self.lock:
+            meta = list(self.db.iterator(prefix=self.META_PREFIX))
+            self.db.close()
+            plyvel.destroy_db(self.dirname)
+            self.db = self._open()
+            if self.count is not None:
+                self.count = 0
+            self.count_saved = False
+            with self.db.write_batch(sync=self.sync) as write_batch:
+                for key, value in meta:
+                    if key != self.count_key:
+                        write_batch.put(key, value)
+
+    def _count(self) -> int:
+        if self.count is None:
+            # Without count_keys, a count saved by an earlier writer is only
+            # valid until the first write
+            if self.count_saved:
+                return int(self.db.get(self.count_key))
+            return super()._count()
+        return self.count
 
 
 class CachedKVFileLevelDB(CachedKVFile):
-    def __init__(self, serializer: SerializerBase=None, location=None, size=CachedKVFile.DEFAULT_CACHE_SIZE):
-        super().__init__(KVFileLevelDB, serializer=serializer, location=location, size=size)
+    def __init__(self, serializer: SerializerBase=None, location=None, size=CachedKVFile.DEFAULT_CACHE_SIZE,
+                 writeback_size=CachedKVFile.DEFAULT_WRITEBACK_SIZE, dictionary_samples=0, thread_safe=False,
+                 readonly=False, bloom_error_rate=None, policy='lru', max_bytes=None, ttl=None,
+                 key_codec: KeyCodecBase=None, **kw):
+        # plyvel is thread safe, only the cache needs locking
+        super().__init__(partial(KVFileLevelDB, readonly=readonly, **kw), serializer=serializer, location=location,
+                         size=size, writeback_size=writeback_size, dictionary_samples=dictionary_samples,
+                         thread_safe=thread_safe, readonly=readonly,
+                         bloom_error_rate=bloom_error_rate, policy=policy, max_bytes=max_bytes, ttl=ttl,
+                         key_codec=key_codec)
@@ -0,0 +1,469 @@
+import os
+import re
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from bisect import bisect_left
+from functools import partial
+from itertools import accumulate
+from typing import Iterator, List
+
+from .base import KVFileBase, KeySValueIterator, key_bytes
+from .cached import CachedKVFile
+from .key_codec import KeyCodecBase
+from .serializer_base import SerializerBase
+
+# Segment files are sequences of records:
+#   header: crc32, kind, key length, value length
+#   key (utf8, or encoded by the key codec)
+#   value
+# The crc covers the rest of the header, the key and the value.
+# Hint files list the records of a sealed segment without their values,
+# column by column so that they're loaded in bulk:
+#   header: magic, number of records
+#   kinds (uint8)
+#   value lengths (uint32)
+#   value offsets (uint64)
+#   keys (utf8), separated by 0xff bytes (which utf8 never contains)
+# Typed keys may contain 0xff, so stores with a key codec write a variant
+# (BINARY_HINT_MAGIC) with an array of key lengths (uint32) before the keys.
+# Numbers are little endian.
+RECORD_HEADER = struct.Struct('<IBII')
+CRC = struct.Struct('<I')
+RECORD_HEADER_TAIL = struct.Struct('<BII')
+HINT_MAGIC = b'KVFHNT01'
+BINARY_HINT_MAGIC = b'KVFHNT02'
+HINT_HEADER = struct.Struct('<8sQ')
+PUT, DELETE, META = 0, 1, 2
+SEGMENT_NAME = re.compile(r'^(\d{8})\.data$')
+
+
+def _array_bytes(values: array) -> bytes:
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _array_from(typecode: str, data: bytes) -> array:
+    ret = array(typecode, data)
+    if sys.byteorder != 'little':
+        ret.byteswap()
+    return ret
+
+
+class KVFileLog(KVFileBase):
+    """
+    Log structured store: values are appended to segment files, and an
+    in-memory index maps each key to the segment, offset and length of its
+    latest value, so that a lookup is a single read.
+    Sealed segments get a hint file with their keys and offsets, so that
+    reopening the store doesn't read the values. Overwritten and deleted
+    values are reclaimed by compaction, which rewrites the live values
+    in key order.
+    Scans sort the keys on demand, which suits stores that are mostly
+    written once and then looked up by key.
+    """
+
+    MAX_SEGMENT_BYTES = 64 * 1024 * 1024
+    # Compact when a segment is sealed and more than this part of the
+    # segments is dead (overwritten or deleted values)
+    COMPACTION_THRESHOLD = 0.5
+    WRITE_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, serializer: SerializerBase=None, location=None, max_segment_bytes=MAX_SEGMENT_BYTES,
+                 compaction_threshold=COMPACTION_THRESHOLD, sync=False, dictionary_samples=0, readonly=False,
+                 key_codec: KeyCodecBase=None):
+        super().__init__(serializer=serializer, location=location, dictionary_samples=dictionary_samples,
+                         readonly=readonly, key_codec=key_codec)
+        self.max_segment_bytes = max_segment_bytes
+        self.compaction_threshold = compaction_threshold
+        self.sync = sync
+        self.lock = threading.RLock()
+        # key -> slot in the index arrays. Slots of deleted keys are reused
+        self.slots = {}
+        self.free_slots = []
+        self.segments = array('I')
+        self.offsets = array('Q')
+        self.lengths = array('I')
+        self.meta = {}
+        self.fds = {}
+        self.sizes = {}
+        self.live_bytes = 0
+        self.total_bytes = 0
+        # Sorted keys for scans, dropped when keys are added or deleted
+        self.sorted_keys = None
+        self.active = None
+        self.active_id = None
+        self.flushed = 0
+        self.check_compaction = False
+        if not readonly:
+            os.makedirs(self.dirname, exist_ok=True)
+        self._load()
+
+    def _path(self, segment_id: int, suffix: str) -> str:
+        return os.path.join(self.dirname, '{:08d}.{}'.format(segment_id, suffix))
+
+    def _load(self):
+        segment_ids = sorted(
+            int(match.group(1))
+            for match in map(SEGMENT_NAME.match, os.listdir(self.dirname))
+            if match is not None
+        )
+        for segment_id in segment_ids:
+            fd = self.fds[segment_id] = os.open(self._path(segment_id, 'data'), os.O_RDONLY)
+            self.sizes[segment_id] = os.fstat(fd).st_size
+            hint = self._path(segment_id, 'hint')
+            if os.path.exists(hint):
+                self._load_hint(segment_id, hint)
+            else:
+                # Not sealed, e.g. the store wasn't closed properly
+                self._load_segment(segment_id)
+                if not self.readonly:
+                    self._write_hint(segment_id)
+        self.total_bytes = sum(self.sizes.values())
+        self.next_id = segment_ids[-1] + 1 if segment_ids else 0
+
+    def _apply(self, kind: int, key, segment_id: int, offset: int, length: int):
+        # key as indexed (str, or bytes for typed keys), metadata names
+        # may be either
+        if kind == PUT:
+            self._index(key, segment_id, offset, length, len(key_bytes(key)))
+        elif kind == DELETE:
+            self._unindex(key)
+        else:
+            self.meta[key.decode('utf8') if key.__class__ is bytes else key] = \
+                os.pread(self.fds[segment_id], length, offset)
+
+    def _load_hint(self, segment_id: int, hint: str):
+        with open(hint, 'rb') as f:
+            data = f.read()
+        magic, count = HINT_HEADER.unpack_from(data)
+        assert magic == (BINARY_HINT_MAGIC if self.binary_keys else HINT_MAGIC), 'Invalid hint file {}'.format(hint)
+        pos = HINT_HEADER.size
+        kinds = data[pos:pos + count]
+        pos += count
+        lengths = _array_from('I', data[pos:pos + 4 * count])
+        pos += 4 * count
+        offsets = _array_from('Q', data[pos:pos + 8 * count])
+        pos += 8 * count
+        if not count:
+            return
+        if self.binary_keys:
+            pos += 4 * count
+            key_offsets = [pos] + [pos + end for end in accumulate(_array_from('I', data[pos - 4 * count:pos]))]
+            keys = [data[start:end] for start, end in zip(key_offsets, key_offsets[1:])]
+            key_size = len(data) - key_offsets[0]
+        else:
+            # Keys never contain lone surrogates, so decoding the 0xff
+            # separators with surrogateescape allows splitting all keys at once
+            keys = data[pos:].decode('utf8', 'surrogateescape').split('\udcff')
+            key_size = len(data) - pos - (count - 1)
+        if DELETE not in kinds and META in kinds:
+            # Metadata is independent of the keys, and is applied first
+            for i in [i for i, kind in enumerate(kinds) if kind == META]:
+                self._apply(META, keys[i], segment_id, offsets[i], lengths[i])
+            puts = [i for i, kind in enumerate(kinds) if kind == PUT]
+            keys = [keys[i] for i in puts]
+            offsets = array('Q', [offsets[i] for i in puts])
+            lengths = array('I', [lengths[i] for i in puts])
+            kinds = bytes(len(puts))
+            count = len(puts)
+            key_size = sum(len(key_bytes(key)) for key in keys)
+        new_slots = dict(zip(keys, range(len(self.segments), len(self.segments) + count)))
+        if DELETE not in kinds and len(new_slots) == count and self.slots.keys().isdisjoint(new_slots):
+            # New keys only (e.g. a store written once, or compacted)
+            self.slots.update(new_slots)
+            self.segments.extend(array('I', [segment_id]) * count)
+            self.offsets.extend(offsets)
+            self.lengths.extend(lengths)
+            self.live_bytes += count * RECORD_HEADER.size + key_size + sum(lengths)
+            self.sorted_keys = None
+            return
+        for kind, key, offset, length in zip(kinds, keys, offsets, lengths):
+            self._apply(kind, key, segment_id, offset, length)
+
+    def _load_segment(self, segment_id: int):
+        with open(self._path(segment_id, 'data'), 'rb') as f:
+            data = f.read()
+        pos = 0
+        while pos + RECORD_HEADER.size <= len(data):
+            crc, kind, key_length, length = RECORD_HEADER.unpack_from(data, pos)
+            end = pos + RECORD_HEADER.size + key_length + length
+            if end > len(data) or zlib.crc32(data[pos + 4:end]) != crc:
+                break
+            key_end = pos + RECORD_HEADER.size + key_length
+            key = data[pos + RECORD_HEADER.size:key_end]
+            if not self.binary_keys:
+                key = key.decode('utf8')
+            self._apply(kind, key, segment_id, key_end, length)
+            pos = end
+        if pos < len(data):
+            # Drop a partially written record at the end
+            self.sizes[segment_id] = pos
+            if not self.readonly:
+                os.truncate(self._path(segment_id, 'data'), pos)
+
+    def _write_hint(self, segment_id: int):
+        # Written from the segment itself, as all its records are needed
+        # (deletes and metadata included), not only the live ones
+        hint = self._path(segment_id, 'hint')
+        with open(self._path(segment_id, 'data'), 'rb') as f:
+            data = f.read(self.sizes[segment_id])
+        kinds = bytearray()
+        lengths = array('I')
+        offsets = array('Q')
+        keys = []
+        pos = 0
+        while pos < len(data):
+            _, kind, key_length, length = RECORD_HEADER.unpack_from(data, pos)
+            key_start = pos + RECORD_HEADER.size
+            kinds.append(kind)
+            lengths.append(length)
+            offsets.append(key_start + key_length)
+            keys.append(data[key_start:key_start + key_length])
+            pos = key_start + key_length + length
+        with open(hint + '.tmp', 'wb') as out:
+            out.write(HINT_HEADER.pack(BINARY_HINT_MAGIC if self.binary_keys else HINT_MAGIC, len(kinds)))
+            out.write(kinds)
+            out.write(_array_bytes(lengths))
+            out.write(_array_bytes(offsets))
+            if self.binary_keys:
+                out.write(_array_bytes(array('I', map(len, keys))))
+                out.write(b''.join(keys))
+            else:
+                out.write(b'\xff'.join(keys))
+        os.replace(hint + '.tmp', hint)
+
+    def _index(self, key: str, segment_id: int, offset: int, length: int, key_length: int):
+        slot = self.slots.get(key)
+        if slot is None:
+            self.live_bytes += RECORD_HEADER.size + key_length + length
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                self.segments[slot], self.offsets[slot], self.lengths[slot] = segment_id, offset, length
+            else:
+                slot = len(self.segments)
+                self.segments.append(segment_id)
+                self.offsets.append(offset)
+                self.lengths.append(length)
+            self.slots[key] = slot
+            self.sorted_keys = None
+        else:
+            self.live_bytes += length - self.lengths[slot]
+            self.segments[slot], self.offsets[slot], self.lengths[slot] = segment_id, offset, length
+
+    def _unindex(self, key: str) -> bool:
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return False
+        self.live_bytes -= RECORD_HEADER.size + len(key_bytes(key)) + self.lengths[slot]
+        self.free_slots.append(slot)
+        self.sorted_keys = None
+        return True
+
+    def _close_db(self):
+        if hasattr(self, 'fds'):
+            with self.lock:
+                if self.active is not None:
+                    self._seal()
+                for fd in self.fds.values():
+                    os.close(fd)
+                self.fds.clear()
+
+    # Writing
+
+    def _append(self, records: List[tuple]):
+        # records are (kind, key, value) tuples
+        if self.active is None:
+            self._open_segment()
+        segment_id = self.active_id
+        offset = start = self.sizes[segment_id]
+        chunks = []
+        for kind, key, value in records:
+            encoded = key_bytes(key)
+            tail = RECORD_HEADER_TAIL.pack(kind, len(encoded), len(value))
+            chunks.extend((CRC.pack(zlib.crc32(value, zlib.crc32(encoded, zlib.crc32(tail)))), tail, encoded, value))
+            offset += RECORD_HEADER.size + len(encoded)
+            if kind == PUT:
+                self._index(key, segment_id, offset, len(value), len(encoded))
+            elif kind == DELETE:
+                self._unindex(key)
+            else:
+                self.meta[key] = value
+            offset += len(value)
+        self.active.write(b''.join(chunks))
+        self.sizes[segment_id] = offset
+        self.total_bytes += offset - start
+        if self.sync:
+            self._flush()
+            os.fsync(self.active.fileno())
+        if offset >= self.max_segment_bytes:
+            self._seal()
+            self.check_compaction = True
+
+    def _open_segment(self):
+        self.active_id = self.next_id
+        self.next_id += 1
+        path = self._path(self.active_id, 'data')
+        self.active = open(path, 'ab', buffering=self.WRITE_BUFFER_SIZE)
+        self.fds[self.active_id] = os.open(path, os.O_RDONLY)
+        self.sizes[self.active_id] = 0
+        self.flushed = 0
+
+    def _flush(self):
+        self.active.flush()
+        self.flushed = self.sizes[self.active_id]
+
+    def _seal(self):
+        self.active.close()
+        self._write_hint(self.active_id)
+        self.active = None
+        self.active_id = None
+
+    def _write(self, records: List[tuple]):
+        with self.lock:
+            self._append(records)
+            if self.check_compaction:
+                self.check_compaction = False
+                if self.total_bytes and 1 - self.live_bytes / self.total_bytes > self.compaction_threshold:
+                    self.compact()
+
+    def compact(self):
+        """
+        Rewrite the live values into new segments, in key order, and
+        delete the old segments.
+        """
+        assert not self.closed
+        self._check_writable()
+        with self.lock:
+            if self.active is not None:
+                self._seal()
+            old_ids = list(self.fds)
+            self.total_bytes = 0
+            self._append([(META, name, value) for name, value in self.meta.items()])
+            keys = sorted(self.slots)
+            for i in range(0, len(keys), self.DEFAULT_BATCH_SIZE):
+                self._append([
+                    (PUT, key, self._read(self.slots[key]))
+                    for key in keys[i:i + self.DEFAULT_BATCH_SIZE]
+                ])
+            if self.active is not None:
+                self._seal()
+            self.check_compaction = False
+            for segment_id in old_ids:
+                os.close(self.fds.pop(segment_id))
+                del self.sizes[segment_id]
+                os.unlink(self._path(segment_id, 'data'))
+                os.unlink(self._path(segment_id, 'hint'))
+            self.total_bytes = sum(self.sizes.values())
+
+    def _read(self, slot: int) -> bytes:
+        segment_id, offset, length = self.segments[slot], self.offsets[slot], self.lengths[slot]
+        if segment_id == self.active_id and offset + length > self.flushed:
+            self._flush()
+        return os.pread(self.fds[segment_id], length, offset)
+
+    def _set_db(self, key: str, value: bytes) -> None:
+        self._write([(PUT, key, value)])
+
+    def _set_db_batch(self, batch: KeySValueIterator) -> None:
+        self._write([(PUT, key, value) for key, value in batch])
+
+    def _del_db(self, key: str) -> None:
+        self._del_db_batch([key])
+
+    def _del_db_batch(self, keys: List[str]) -> None:
+        with self.lock:
+            keys = [key for key in dict.fromkeys(keys) if key in self.slots]
+            if keys:
+                self._write([(DELETE, key, b'') for key in keys])
+
+    def _del_db_range(self, start=None, stop=None) -> None:
+        with self.lock:
+            self._del_db_batch(self._sorted_range(start, stop))
+
+    def _clear_db(self) -> None:
+        # Start over with empty segments, keeping the metadata
+        with self.lock:
+            if self.active is not None:
+                self._seal()
+            for segment_id, fd in self.fds.items():
+                os.close(fd)
+                os.unlink(self._path(segment_id, 'data'))
+                os.unlink(self._path(segment_id, 'hint'))
+            self.fds.clear()
+            self.sizes.clear()
+            self.slots.clear()
+            self.free_slots.clear()
+            del self.segments[:], self.offsets[:], self.lengths[:]
+            self.sorted_keys = None
+            self.live_bytes = self.total_bytes = 0
+            if self.meta:
+                self._append([(META, name, value) for name, value in self.meta.items()])
+
+    # Reading
+
+    def _get_db(self, key: str) -> bytes:
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None:
+                return None
+            return self._read(slot)
+
+    def _get_db_many(self, keys: List[str]) -> List[bytes]:
+        # Read in file order
+        with self.lock:
+            slots = {key: self.slots.get(key) for key in keys}
+            found = {
+                key: self._read(slot)
+                for key, slot in sorted(
+                    ((key, slot) for key, slot in slots.items() if slot is not None),
+                    key=lambda item: (self.segments[item[1]], self.offsets[item[1]])
+                )
+            }
+        return [found.get(key) for key in keys]
+
+    def _sorted_range(self, start=None, stop=None) -> List[str]:
+        with self.lock:
+            if self.sorted_keys is None:
+                self.sorted_keys = sorted(self.slots)
+            keys = self.sorted_keys
+        return keys[
+            0 if start is None else bisect_left(keys, start):
+            len(keys) if stop is None else bisect_left(keys, stop)
+        ]
+
+    def _keys(self, reverse=False, start=None, stop=None) -> Iterator[str]:
+        keys = self._sorted_range(start, stop)
+        return reversed(keys) if reverse else iter(keys)
+
+    def _db_items(self, reverse=False, start=None, stop=None) -> KeySValueIterator:
+        # Keys deleted during the scan are skipped
+        for key in self._keys(reverse, start, stop):
+            value = self._get_db(key)
+            if value is not None:
+                yield key, value
+
+    def _count(self) -> int:
+        return len(self.slots)
+
+    def _get_meta(self, name: str) -> bytes:
+        return self.meta.get(name)
+
+    def _set_meta(self, name: str, value: bytes) -> None:
+        self._write([(META, name, value)])
+
+
+class CachedKVFileLog(CachedKVFile):
+    def __init__(self, serializer: SerializerBase=None, location=None, size=CachedKVFile.DEFAULT_CACHE_SIZE,
+                 writeback_size=CachedKVFile.DEFAULT_WRITEBACK_SIZE, dictionary_samples=0, thread_safe=False,
+                 readonly=False, bloom_error_rate=None, policy='lru', max_bytes=None, ttl=None,
+                 key_codec: KeyCodecBase=None, **kw):
+        super().__init__(partial(KVFileLog, readonly=readonly, **kw), serializer=serializer, location=location,
+                         size=size, writeback_size=writeback_size, dictionary_samples=dictionary_samples,
+                         thread_safe=thread_safe, readonly=readonly,
+                         bloom_error_rate=bloom_error_rate, policy=policy, max_bytes=max_bytes, ttl=ttl,
+                         key_codec=key_codec)
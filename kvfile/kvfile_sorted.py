@@ -0,0 +1,62 @@
+from itertools import islice
+from typing import Iterator
+
+from .base import KVFileBase, KeySValueIterator, key_bytes
+from .key_codec import KeyCodecBase
+from .serializer_base import SerializerBase
+from .sorted_table import SortedTable
+
+
+def _encode(key: str) -> bytes:
+    return None if key is None else key_bytes(key)
+
+
+class KVFileSortedTable(KVFileBase):
+    """
+    Read only store over an immutable sorted table file, as written by `export()`.
+    The file is memory mapped: lookups are a binary search over the key index,
+    and scans read the keys and values sequentially off the mapping.
+    """
+
+    def __init__(self, serializer: SerializerBase=None, location=None, key_codec: KeyCodecBase=None):
+        super().__init__(serializer=serializer, location=location, readonly=True, key_codec=key_codec)
+        self.table = SortedTable(self.filename, binary_keys=self.binary_keys)
+
+    def _close_db(self):
+        if hasattr(self, 'table'):
+            self.table.close()
+            del self.table
+
+    def get_raw(self, key: str, **kw) -> memoryview:
+        # Values are returned as views into the mapping, without copying
+        assert not self.closed
+        i = self.table.find(key_bytes(self._encode_key(key)))
+        if i < 0:
+            if 'default' in kw:
+                return kw['default']
+            raise KeyError()
+        return self.table.value(i)
+
+    def items_raw(self, reverse=False, prefix=None, start=None, stop=None, limit=None) -> KeySValueIterator:
+        assert not self.closed
+        start, stop = self._key_range(prefix, start, stop)
+        items = self.table.items(reverse, _encode(start), _encode(stop), views=True)
+        if limit is not None:
+            items = islice(items, limit)
+        return self._decode_items(items)
+
+    def _get_db(self, key: str) -> bytes:
+        i = self.table.find(key_bytes(key))
+        return None if i < 0 else self.table.value_bytes(i)
+
+    def _db_items(self, reverse=False, start=None, stop=None) -> KeySValueIterator:
+        return self.table.items(reverse, _encode(start), _encode(stop))
+
+    def _keys(self, reverse=False, start=None, stop=None) -> Iterator[str]:
+        return self.table.keys(reverse, _encode(start), _encode(stop))
+
+    def _count(self) -> int:
+        return self.table.count
+
+    def _get_meta(self, name: str) -> bytes:
+        return self.table.meta.get(name)
@@ -1,83 +1,301 @@
+import os
 import sqlite3
-from typing import Iterator
+import threading
+from contextlib import nullcontext
+from functools import partial
+from typing import Iterator, List
+from urllib.request import pathname2url
 
 from .cached import CachedKVFile
 from .base import KVFileBase, KeySValueIterator
+from .key_codec import KeyCodecBase
 from .serializer import SerializerBase
 
 class KVFileSQLite(KVFileBase):
 
     BATCH_SIZE = 1000
+    # Stay below SQLITE_MAX_VARIABLE_NUMBER on older SQLite builds
+    GET_MANY_CHUNK_SIZE = 500
 
-    def __init__(self, serializer: SerializerBase=None, location=None):
-        super().__init__(serializer=serializer, location=location)
+    JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+    SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+    UPSERT = '''INSERT INTO d VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value=excluded.value'''
+    # UPSERT needs SQLite 3.24, older versions update the existing keys
+    # and then insert the missing ones
+    HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+    UPDATE = '''UPDATE d SET value=? WHERE key=?'''
+    INSERT_MISSING = '''INSERT OR IGNORE INTO d VALUES (?, ?)'''
+
+    def __init__(self, serializer: SerializerBase=None, location=None,
+                 journal_mode='WAL', synchronous='NORMAL', cache_size=None, mmap_size=None, page_size=None,
+                 dictionary_samples=0, thread_safe=False, readonly=False, immutable=False,
+                 count_keys=False, key_codec: KeyCodecBase=None):
+        # Typed keys are bound as bytes, and so stored as BLOBs
+        super().__init__(serializer=serializer, location=location, dictionary_samples=dictionary_samples,
+                         readonly=readonly, key_codec=key_codec)
         if not self.filename.endswith('.sqlite'):
             self.filename += '.sqlite'
-        self.db = sqlite3.connect(self.filename)
+        # In thread safe mode, writes are serialized on self.db and committed
+        # immediately, while each thread reads using its own connection
+        self.thread_safe = thread_safe
+        self.lock = threading.RLock() if thread_safe else nullcontext()
+        self._read_pragmas = (cache_size, mmap_size)
+        self._local = threading.local()
+        self._readers = []
+        # Read only stores are opened with mode=ro, immutable stores also
+        # skip all locking, as they are assumed to never change
+        self.immutable = immutable
+        # With count_keys, triggers maintain the key count on every write
+        self.count_keys = count_keys
+        # Transactions are managed explicitly, see _begin() and _commit().
+        # The connection may be handed over to other threads (e.g. an
+        # AsyncKVFile I/O thread), as long as it's used by one at a time
+        self.db = self._connect()
         self.cursor = self.db.cursor()
-        try:
-            self.cursor.execute('''CREATE TABLE d (key text PRIMARY KEY, value blob)''')
-            self.cursor.execute('''CREATE UNIQUE INDEX i ON d (key)''')
-        except sqlite3.OperationalError:
-            pass
-        self._needs_commit = set()
+        self._pending_writes = 0
+        if readonly:
+            self._set_pragmas(None, None, cache_size, mmap_size, None)
+        else:
+            self._set_pragmas(journal_mode, synchronous, cache_size, mmap_size, page_size)
+            self._create_table()
+
+    def _connect(self):
+        if self.readonly:
+            uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(self.filename)))
+            if self.immutable:
+                uri += '&immutable=1'
+            return sqlite3.connect(uri, uri=True, isolation_level=None, check_same_thread=False)
+        return sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False)
+
+    def _set_pragmas(self, journal_mode, synchronous, cache_size, mmap_size, page_size):
+        # page_size only takes effect for newly created databases
+        if page_size is not None:
+            self.cursor.execute('PRAGMA page_size={:d}'.format(page_size))
+        if journal_mode is not None:
+            assert journal_mode.upper() in self.JOURNAL_MODES
+            self.cursor.execute('PRAGMA journal_mode={}'.format(journal_mode))
+        if synchronous is not None:
+            assert synchronous.upper() in self.SYNCHRONOUS_MODES
+            self.cursor.execute('PRAGMA synchronous={}'.format(synchronous))
+        if cache_size is not None:
+            self.cursor.execute('PRAGMA cache_size={:d}'.format(cache_size))
+        if mmap_size is not None:
+            self.cursor.execute('PRAGMA mmap_size={:d}'.format(mmap_size))
+
+    def _create_table(self):
+        ret = self.cursor.execute("""SELECT sql FROM sqlite_master WHERE type='table' AND name='d'""").fetchone()
+        if ret is None:
+            self.cursor.execute("""CREATE TABLE d (key text PRIMARY KEY, value blob) WITHOUT ROWID""")
+        elif 'WITHOUT ROWID' not in ret[0].upper():
+            # Migrate files created by older versions, which used a rowid
+            # table with a redundant unique index on the key
+            self._begin()
+            self.cursor.execute("""CREATE TABLE d_migrated (key text PRIMARY KEY, value blob) WITHOUT ROWID""")
+            self.cursor.execute("""INSERT INTO d_migrated SELECT key, value FROM d""")
+            self.cursor.execute("""DROP TABLE d""")
+            self.cursor.execute("""ALTER TABLE d_migrated RENAME TO d""")
+            self._commit()
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS m (key text PRIMARY KEY, value blob) WITHOUT ROWID""")
+        counted = self.cursor.execute('''SELECT 1 FROM m WHERE key=?''', (self.COUNT_META,)).fetchone() is not None
+        if self.count_keys and not counted:
+            # Count the keys once, triggers keep the count up to date from then on
+            self._begin()
+            self.cursor.execute('''INSERT INTO m VALUES (?, (SELECT count(*) FROM d))''', (self.COUNT_META,))
+            self._create_triggers()
+            self._commit()
+        elif counted and not self.count_keys:
+            # Written with count_keys before, the count would go stale
+            self._begin()
+            self.cursor.execute('''DROP TRIGGER IF EXISTS d_insert''')
+            self.cursor.execute('''DROP TRIGGER IF EXISTS d_delete''')
+            self.cursor.execute('''DELETE FROM m WHERE key=?''', (self.COUNT_META,))
+            self._commit()
+
+    def _create_triggers(self):
+        # Writes are upserts, so replacing a value doesn't fire the insert trigger
+        for name, event, delta in (('d_insert', 'INSERT', '+ 1'), ('d_delete', 'DELETE', '- 1')):
+            self.cursor.execute(
+                '''CREATE TRIGGER IF NOT EXISTS {} AFTER {} ON d BEGIN '''
+                '''UPDATE m SET value = value {} WHERE key = '{}'; END'''.format(name, event, delta, self.COUNT_META)
+            )
+
+    def _read_cursor(self):
+        if not self.thread_safe:
+            return self.cursor
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None:
+            db = self._connect()
+            cache_size, mmap_size = self._read_pragmas
+            if cache_size is not None:
+                db.execute('PRAGMA cache_size={:d}'.format(cache_size))
+            if mmap_size is not None:
+                db.execute('PRAGMA mmap_size={:d}'.format(mmap_size))
+            with self.lock:
+                self._readers.append(db)
+            cursor = self._local.cursor = db.cursor()
+        return cursor
 
     def _close_db(self):
         if hasattr(self, 'db'):
-            self.db.commit()
-            if hasattr(self, 'cursor'):
-                del self.cursor
-            del self.db
-
-    def _commitW(self, key):
-        if len(self._needs_commit) == self.BATCH_SIZE:
-            self.db.commit()
-            self._needs_commit.clear()
-        else:
-            self._needs_commit.add(key)
+            with self.lock:
+                self._commit()
+                for reader in self._readers:
+                    reader.close()
+                self._readers.clear()
+                if hasattr(self, 'cursor'):
+                    del self.cursor
+                self.db.close()
+                del self.db
+
+    def _begin(self):
+        if not self.db.in_transaction:
+            self.cursor.execute('BEGIN')
 
-    def _commitR(self, key=None):
-        if len(self._needs_commit) and (key is None or key in self._needs_commit):
-            self.db.commit()
-            self._needs_commit.clear()
+    def _commit(self):
+        if self.db.in_transaction:
+            self.cursor.execute('COMMIT')
+            if self.metrics is not None:
+                self.metrics.count('commits')
+        self._pending_writes = 0
+
+    def _write(self):
+        self._pending_writes += 1
+        if self.thread_safe or self._pending_writes >= self.BATCH_SIZE:
+            self._commit()
 
     def _get_db(self, key: str) -> bytes:
-        self._commitR(key)
-        ret = self.cursor.execute('''SELECT value FROM d WHERE key=?''',(key,)).fetchone()
+        ret = self._read_cursor().execute('''SELECT value FROM d WHERE key=?''',(key,)).fetchone()
         if ret is None:
             return None
         else:
             return ret[0]
 
+    def _get_db_many(self, keys: List[str]) -> List[bytes]:
+        found = {}
+        unique_keys = list(set(keys))
+        for i in range(0, len(unique_keys), self.GET_MANY_CHUNK_SIZE):
+            chunk = unique_keys[i:i + self.GET_MANY_CHUNK_SIZE]
+            query = 'SELECT key, value FROM d WHERE key IN ({})'.format(','.join('?' * len(chunk)))
+            found.update(self._read_cursor().execute(query, chunk))
+        return [found.get(key) for key in keys]
+
     def _set_db(self, key: str, value: bytes) -> None:
-        self.cursor.execute('''INSERT OR REPLACE INTO d VALUES (?, ?)''', (key, value))
-        self._commitW(key)
+        with self.lock:
+            self._begin()
+            if self.HAS_UPSERT:
+                self.cursor.execute(self.UPSERT, (key, value))
+            else:
+                self.cursor.execute(self.UPDATE, (value, key))
+                self.cursor.execute(self.INSERT_MISSING, (key, value))
+            self._write()
 
     def _del_db(self, key: str) -> None:
-        self.cursor.execute('''DELETE FROM d WHERE key=?''', (key,)).fetchone()
-        self._commitW(key)
+        with self.lock:
+            self._begin()
+            self.cursor.execute('''DELETE FROM d WHERE key=?''', (key,))
+            self._write()
+
+    def _range_where(self, start=None, stop=None):
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append('key >= ?')
+            params.append(start)
+        if stop is not None:
+            conditions.append('key < ?')
+            params.append(stop)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        return where, params
 
-    def _db_items(self, reverse=False) -> KeySValueIterator:
-        self._commitR()
-        cursor = self.db.cursor()
+    def _range_query(self, columns, reverse=False, start=None, stop=None):
+        where, params = self._range_where(start, stop)
         direction = 'DESC' if reverse else 'ASC'
-        items = cursor.execute('''SELECT key, value FROM d ORDER BY key ''' + direction)
-        for key, value in items:
+        cursor = self._read_cursor().connection.cursor()
+        return cursor.execute('SELECT ' + columns + ' FROM d' + where + ' ORDER BY key ' + direction, params)
+
+    def _db_items(self, reverse=False, start=None, stop=None) -> KeySValueIterator:
+        for key, value in self._range_query('key, value', reverse, start, stop):
             yield key, value
 
-    def _keys(self, reverse=False) -> Iterator[str]:
-        self._commitR()
-        cursor = self.db.cursor()
-        direction = 'DESC' if reverse else 'ASC'
-        keys = cursor.execute('''SELECT key FROM d ORDER BY key ''' + direction)
-        for key, in keys:
+    def _keys(self, reverse=False, start=None, stop=None) -> Iterator[str]:
+        for key, in self._range_query('key', reverse, start, stop):
             yield key
 
+    def _get_meta(self, name: str) -> bytes:
+        try:
+            ret = self._read_cursor().execute('''SELECT value FROM m WHERE key=?''', (name,)).fetchone()
+        except sqlite3.OperationalError:
+            # Read only stores created by older versions have no metadata table
+            return None
+        return None if ret is None else ret[0]
+
+    def _set_meta(self, name: str, value: bytes) -> None:
+        with self.lock:
+            self._begin()
+            self.cursor.execute('''INSERT OR REPLACE INTO m VALUES (?, ?)''', (name, value))
+            self._commit()
+
     def _set_db_batch(self, batch: KeySValueIterator) -> None:
-        self.cursor.executemany('''INSERT OR REPLACE INTO d VALUES (?, ?)''', batch)
-        self._commitR()
+        with self.lock:
+            self._begin()
+            if self.HAS_UPSERT:
+                self.cursor.executemany(self.UPSERT, batch)
+            else:
+                # The last value of keys repeated in the batch wins
+                batch = dict(batch)
+                self.cursor.executemany(self.UPDATE, ((value, key) for key, value in batch.items()))
+                self.cursor.executemany(self.INSERT_MISSING, batch.items())
+            self._commit()
+
+    def _del_db_batch(self, keys: List[str]) -> None:
+        with self.lock:
+            self._begin()
+            self.cursor.executemany('''DELETE FROM d WHERE key=?''', ((key,) for key in keys))
+            self._commit()
+
+    def _del_db_range(self, start=None, stop=None) -> None:
+        where, params = self._range_where(start, stop)
+        with self.lock:
+            self._begin()
+            self.cursor.execute('DELETE FROM d' + where, params)
+            self._commit()
+
+    def _clear_db(self) -> None:
+        # Dropping the table is much faster than deleting its rows one by
+        # one, which is what DELETE does when the table has triggers
+        with self.lock:
+            self._begin()
+            try:
+                self.cursor.execute('''DROP TABLE d''')
+            except sqlite3.OperationalError:
+                # The table is still being read by an open iterator
+                self.cursor.execute('''DELETE FROM d''')
+            else:
+                self.cursor.execute("""CREATE TABLE d (key text PRIMARY KEY, value blob) WITHOUT ROWID""")
+                if self.count_keys:
+                    self._create_triggers()
+                    self.cursor.execute('''UPDATE m SET value = 0 WHERE key = ?''', (self.COUNT_META,))
+            self._commit()
+
+    def _count(self) -> int:
+        cursor = self._read_cursor()
+        try:
+            ret = cursor.execute('''SELECT value FROM m WHERE key=?''', (self.COUNT_META,)).fetchone()
+        except sqlite3.OperationalError:
+            ret = None
+        if ret is None:
+            # Written without count_keys
+            ret = cursor.execute('''SELECT count(*) FROM d''').fetchone()
+        return ret[0]
 
 
 class CachedKVFileSQLite(CachedKVFile):
-    def __init__(self, serializer: SerializerBase=None, location=None, size=CachedKVFile.DEFAULT_CACHE_SIZE):
-        super().__init__(KVFileSQLite, serializer=serializer, location=location, size=size)
+    def __init__(self, serializer: SerializerBase=None, location=None, size=CachedKVFile.DEFAULT_CACHE_SIZE,
+                 writeback_size=CachedKVFile.DEFAULT_WRITEBACK_SIZE, dictionary_samples=0, thread_safe=False,
+                 readonly=False, bloom_error_rate=None, policy='lru', max_bytes=None, ttl=None,
+                 key_codec: KeyCodecBase=None, **kw):
+        super().__init__(partial(KVFileSQLite, thread_safe=thread_safe, readonly=readonly, **kw), serializer=serializer,
+                         location=location, size=size, writeback_size=writeback_size,
+                         dictionary_samples=dictionary_samples, thread_safe=thread_safe, readonly=readonly,
+                         bloom_error_rate=bloom_error_rate, policy=policy, max_bytes=max_bytes, ttl=ttl,
+                         key_codec=key_codec)
@@ -0,0 +1,149 @@
+import threading
+from bisect import bisect_left
+from time import perf_counter
+from typing import Callable
+
+from .serializer_base import SerializerBase
+
+# Histogram bucket upper bounds, in seconds: 1us to ~8s, doubling
+LATENCY_BOUNDS = [1e-6 * 2 ** i for i in range(24)]
+
+
+class Histogram():
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def stats(self) -> dict:
+        return dict(
+            count=self.count, sum=self.sum, max=self.max,
+            buckets={
+                bound: count
+                for bound, count in zip(self.bounds + [float('inf')], self.buckets)
+                if count
+            }
+        )
+
+
+class Metrics():
+    """
+    Counters and latency histograms of a store, see `KVFileBase.enable_metrics()`.
+    `hook(name, value)` is also called for every observation: with the
+    duration in seconds for latencies, and with the increment for counters.
+    """
+
+    def __init__(self, hook: Callable[[str, float], None]=None, prefix=''):
+        self.hook = hook
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def prefixed(self, prefix: str) -> 'Metrics':
+        """A view on the same metrics, prefixing all names with `prefix`."""
+        ret = Metrics(self.hook, self.prefix + prefix)
+        ret.lock, ret.counters, ret.histograms = self.lock, self.counters, self.histograms
+        return ret
+
+    def count(self, name: str, n=1):
+        name = self.prefix + name
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        if self.hook is not None:
+            self.hook(name, n)
+
+    def observe(self, name: str, seconds: float):
+        name = self.prefix + name
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+        if self.hook is not None:
+            self.hook(name, seconds)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(
+                counters=dict(self.counters),
+                latencies={name: histogram.stats() for name, histogram in self.histograms.items()},
+            )
+
+
+_instrumented_classes = {}
+
+
+def _timed(cls, name: str):
+    func = getattr(super(cls, cls), name)
+    metric = name.lstrip('_')
+
+    def timed(self, *args, **kw):
+        start = perf_counter()
+        try:
+            return func(self, *args, **kw)
+        finally:
+            self.metrics.observe(metric, perf_counter() - start)
+
+    timed.__name__ = name
+    return timed
+
+
+def instrumented_class(cls):
+    """
+    Subclass of `cls` timing its TIMED_METHODS (and adding its METRICS_MIXIN).
+    Instances are switched to it when metrics are enabled, so that other
+    instances don't pay for the instrumentation.
+    """
+    ret = _instrumented_classes.get(cls)
+    if ret is None:
+        mixin = getattr(cls, 'METRICS_MIXIN', None)
+        ret = type(cls.__name__, (mixin, cls) if mixin is not None else (cls,), dict(__module__=cls.__module__))
+        for name in cls.TIMED_METHODS:
+            setattr(ret, name, _timed(ret, name))
+        _instrumented_classes[cls] = ret
+    return ret
+
+
+def _identity(obj):
+    return obj
+
+
+class MeasuredSerializer(SerializerBase):
+    """Times a serializer and counts the bytes it produces and consumes."""
+
+    def __init__(self, serializer: SerializerBase, metrics: Metrics):
+        self._serializer = serializer
+        self._metrics = metrics
+
+    def serialize(self, obj: object) -> bytes:
+        start = perf_counter()
+        ret = self._serializer.serialize(obj)
+        self._metrics.observe('serialize', perf_counter() - start)
+        self._metrics.count('serialize.bytes', len(ret))
+        return ret
+
+    def deserialize(self, s: bytes) -> object:
+        start = perf_counter()
+        ret = self._serializer.deserialize(s)
+        self._metrics.observe('deserialize', perf_counter() - start)
+        self._metrics.count('deserialize.bytes', len(s))
+        return ret
+
+    def __getattr__(self, name):
+        # e.g. the dictionary methods of a CompressedSerializer
+        return getattr(self._serializer, name)
+
+    # Copies sent to worker processes are not measured
+    def __reduce__(self):
+        return _identity, (self._serializer,)
@@ -1,5 +1,9 @@
 from .serializer_base import SerializerBase
 from .serializer_pickle import PickleSerializer
-from .serializer_json import JsonSerializer
+from .serializer_json import JsonSerializer, FastJsonSerializer
+from .serializer_compressed import CompressedSerializer
+
+__all__ = ['SerializerBase', 'PickleSerializer', 'JsonSerializer', 'FastJsonSerializer', 'CompressedSerializer',
+           'DefaultSerializer']
 
 DefaultSerializer: SerializerBase = PickleSerializer
\ No newline at end of file
@@ -0,0 +1,179 @@
+import lzma
+import zlib
+
+from .serializer_base import SerializerBase
+from .serializer_pickle import PickleSerializer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# One-byte headers stored in front of every value
+RAW = 0
+ZLIB = 1
+LZMA = 2
+ZSTD = 3
+LZ4 = 4
+ZLIB_DICT = 5
+ZSTD_DICT = 6
+
+CODECS = dict(zlib=ZLIB, lzma=LZMA, zstd=ZSTD, lz4=LZ4)
+
+# zlib only uses the last 32KB of a preset dictionary
+DICTIONARY_SIZE = 32 * 1024
+
+
+def _compressor(codec, level):
+    if codec == ZLIB:
+        level = -1 if level is None else level
+        return lambda data: zlib.compress(data, level)
+    if codec == LZMA:
+        return lambda data: lzma.compress(data, preset=level)
+    if codec == ZSTD:
+        assert zstandard is not None, 'zstd compression requires the zstandard package'
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress
+    if codec == LZ4:
+        assert lz4 is not None, 'lz4 compression requires the lz4 package'
+        level = 0 if level is None else level
+        return lambda data: lz4.frame.compress(data, compression_level=level)
+    raise ValueError('Unknown compression codec {}'.format(codec))
+
+
+def _dictionary_compressor(codec, level, data):
+    if codec == ZLIB_DICT:
+        level = -1 if level is None else level
+
+        def compress(value):
+            compressor = zlib.compressobj(level, zdict=data)
+            return compressor.compress(value) + compressor.flush()
+        return compress
+    if codec == ZSTD_DICT:
+        assert zstandard is not None, 'zstd compression requires the zstandard package'
+        return zstandard.ZstdCompressor(level=3 if level is None else level,
+                                        dict_data=zstandard.ZstdCompressionDict(data)).compress
+    raise ValueError('Unknown dictionary codec {}'.format(codec))
+
+
+def _dictionary_decompressor(codec, data):
+    if codec == ZLIB_DICT:
+        def decompress(value):
+            decompressor = zlib.decompressobj(zdict=data)
+            return decompressor.decompress(value) + decompressor.flush()
+        return decompress
+    if codec == ZSTD_DICT:
+        assert zstandard is not None, 'zstd compression requires the zstandard package'
+        return zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(data)).decompress
+    raise ValueError('Unknown dictionary codec {}'.format(codec))
+
+
+def _train(codec, samples):
+    if codec == ZSTD_DICT:
+        try:
+            return zstandard.train_dictionary(DICTIONARY_SIZE, samples).as_bytes()
+        except zstandard.ZstdError:
+            # Too few samples to train on, fall back to using them as is
+            pass
+    # Substrings closer to the end of the dictionary are cheaper to
+    # reference, so keep the first samples last
+    ret = b''
+    for sample in samples:
+        if len(ret) + len(sample) > DICTIONARY_SIZE:
+            break
+        ret = sample + ret
+    return ret
+
+
+def _decompressors():
+    ret = {
+        ZLIB: zlib.decompress,
+        LZMA: lzma.decompress,
+    }
+    if zstandard is not None:
+        ret[ZSTD] = zstandard.ZstdDecompressor().decompress
+    if lz4 is not None:
+        ret[LZ4] = lz4.frame.decompress
+    return ret
+
+
+class CompressedSerializer(SerializerBase):
+    """
+    Compresses the output of another serializer.
+    Values shorter than `threshold` bytes (or that don't shrink) are stored
+    as is, a one-byte header tells them apart from compressed values.
+
+    A dictionary trained on sample values (see `train_dictionary`) makes
+    small, similar values compress well. `dictionary_loader` is called once,
+    before the first use, to load a previously trained dictionary.
+    """
+
+    DEFAULT_THRESHOLD = 256
+
+    def __init__(self, serializer: SerializerBase=None, codec='zlib', level=None, threshold=DEFAULT_THRESHOLD):
+        self.serializer = serializer or PickleSerializer()
+        self.codec_name = codec
+        self.codec = CODECS[codec]
+        self.level = level
+        self.threshold = threshold
+        self.header = bytes([self.codec])
+        self.compress = _compressor(self.codec, level)
+        self.decompressors = _decompressors()
+        self.dictionary = None
+        self.dictionary_loader = None
+
+    def train_dictionary(self, samples) -> bytes:
+        """Train a dictionary on serialized sample values and start using it.
+        Returns the dictionary, to be passed to `set_dictionary` later."""
+        codec = ZSTD_DICT if self.codec == ZSTD else ZLIB_DICT
+        dictionary = bytes([codec]) + _train(codec, samples)
+        self.set_dictionary(dictionary)
+        return dictionary
+
+    def set_dictionary(self, dictionary: bytes):
+        codec, data = dictionary[0], dictionary[1:]
+        self.dictionary = dictionary
+        self.dictionary_loader = None
+        self.header = bytes([codec])
+        self.compress = _dictionary_compressor(codec, self.level, data)
+        self.decompressors[codec] = _dictionary_decompressor(codec, data)
+
+    def _load_dictionary(self):
+        loader, self.dictionary_loader = self.dictionary_loader, None
+        dictionary = loader()
+        if dictionary is not None:
+            self.set_dictionary(dictionary)
+
+    def serialize(self, obj: object) -> bytes:
+        if self.dictionary_loader is not None:
+            self._load_dictionary()
+        data = self.serializer.serialize(obj)
+        if len(data) >= self.threshold:
+            compressed = self.compress(data)
+            if len(compressed) < len(data):
+                return self.header + compressed
+        return b'\x00' + data
+
+    def deserialize(self, s: bytes) -> object:
+        codec = s[0]
+        if codec == RAW:
+            return self.serializer.deserialize(s[1:])
+        if codec not in self.decompressors and self.dictionary_loader is not None:
+            self._load_dictionary()
+        return self.serializer.deserialize(self.decompressors[codec](s[1:]))
+
+    # Compressor functions can't be pickled, recreate them instead
+    def __getstate__(self):
+        if self.dictionary_loader is not None:
+            self._load_dictionary()
+        return (self.serializer, self.codec_name, self.level, self.threshold, self.dictionary)
+
+    def __setstate__(self, state):
+        self.__init__(*state[:4])
+        if state[4] is not None:
+            self.set_dictionary(state[4])
@@ -6,6 +6,11 @@ import isodate
 
 from .serializer_base import SerializerBase
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 DATE_FORMAT = '%Y-%m-%d'
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
@@ -99,3 +104,78 @@ class JsonSerializer(SerializerBase):
 
     def deserialize(self, s: bytes) -> object:
         return json.loads(s.decode('utf-8'), cls=self.decoder)
+
+
+TAG_PARSERS = {
+    'type{decimal}': decimal.Decimal,
+    'type{time}': datetime.time.fromisoformat,
+    'type{datetime}': datetime.datetime.fromisoformat,
+    'type{date}': datetime.date.fromisoformat,
+    'type{duration}': isodate.parse_duration,
+    'type{set}': set,
+}
+
+
+def tagged_object_hook(obj):
+    """
+    Faster equivalent of CommonJSONDecoder.object_hook:
+    tagged values are always encoded as single-key objects, so only these
+    need a (single) lookup.
+    """
+    if len(obj) == 1:
+        (key, value), = obj.items()
+        parser = TAG_PARSERS.get(key)
+        if parser is not None:
+            try:
+                return parser(value)
+            except (ValueError, TypeError, ArithmeticError):
+                pass
+    return obj
+
+
+class FastJsonSerializer(SerializerBase):
+    """
+    Reads and writes the same format as JsonSerializer, but decodes
+    tagged values with a single lookup per object. Keys are not sorted
+    unless `sort_keys` is set. When installed, orjson is used for encoding
+    unless `use_orjson` is False (decoding with the stdlib decoder and
+    an object hook is faster than post-processing orjson's output).
+    orjson writes NaN and Infinity as null, so values containing nulls
+    (or the string "null") are encoded again with the stdlib encoder, and
+    are faster to encode with `use_orjson=False`.
+    """
+
+    def __init__(self, sort_keys=False, use_orjson=None):
+        self.sort_keys = sort_keys
+        self.use_orjson = orjson is not None if use_orjson is None else use_orjson
+        assert orjson is not None or not self.use_orjson, 'orjson is not installed'
+        self.encoder = CommonJSONEncoder(sort_keys=sort_keys, ensure_ascii=False)
+        self.decoder = json.JSONDecoder(object_hook=tagged_object_hook)
+        if self.use_orjson:
+            self.orjson_options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+            if sort_keys:
+                self.orjson_options |= orjson.OPT_SORT_KEYS
+
+    def serialize(self, obj: object) -> bytes:
+        if self.use_orjson:
+            try:
+                ret = orjson.dumps(obj, default=self.encoder.default, option=self.orjson_options)
+                # orjson writes NaN and Infinity as null. Telling them apart
+                # from None costs about as much as the stdlib encoder, which
+                # is used for all values containing nulls instead
+                if b'null' not in ret:
+                    return ret
+            except orjson.JSONEncodeError:
+                # e.g. integers larger than 64 bits
+                pass
+        return self.encoder.encode(obj).encode('utf-8')
+
+    def deserialize(self, s: bytes) -> object:
+        return self.decoder.decode(s.decode('utf-8'))
+
+    # The encoder and decoder are recreated when unpickling
+    def __getstate__(self):
+        return (self.sort_keys, self.use_orjson)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
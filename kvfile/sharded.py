@@ -0,0 +1,139 @@
+import heapq
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List
+
+from .base import KVFileBase, KeySValueIterator, key_bytes
+from .key_codec import KeyCodecBase
+from .serializer_base import SerializerBase
+
+try:
+    from .kvfile_leveldb import KVFileLevelDB as DefaultKVFile
+except ImportError:
+    from .kvfile_sqlite import KVFileSQLite as DefaultKVFile
+
+
+class ShardedKVFile(KVFileBase):
+    """
+    Hash-partitions keys across several backend instances, stored in
+    subdirectories of the location.
+    Batched writes are applied to all shards in parallel, and scans merge
+    the (sorted) shard iterators, so results are still globally sorted.
+    """
+
+    DEFAULT_SHARDS = 4
+    SHARDS_META = 'shards'
+
+    def __init__(self, kvfile_cls: KVFileBase=None, serializer: SerializerBase=None, location=None,
+                 shards=DEFAULT_SHARDS, workers=None, dictionary_samples=0, readonly=False,
+                 key_codec: KeyCodecBase=None):
+        super().__init__(serializer=serializer, location=location, dictionary_samples=dictionary_samples,
+                         readonly=readonly, key_codec=key_codec)
+        kvfile_cls = kvfile_cls or DefaultKVFile
+        if not readonly:
+            os.makedirs(self.dirname, exist_ok=True)
+        self.shards = [
+            kvfile_cls(serializer=self.serializer, location=os.path.join(self.dirname, 'shard-{:03d}'.format(i)),
+                       readonly=readonly, key_codec=key_codec)
+            for i in range(shards)
+        ]
+        existing = self.shards[0]._get_meta(self.SHARDS_META)
+        if existing is None:
+            if not readonly:
+                self.shards[0]._set_meta(self.SHARDS_META, str(shards).encode('ascii'))
+        elif int(existing) != shards:
+            self.close()
+            raise ValueError('Store at {} has {} shards, not {}'.format(self.dirname, int(existing), shards))
+        self.executor = ThreadPoolExecutor(workers or shards, thread_name_prefix='kvfile-shard')
+
+    def _shard(self, key: str) -> KVFileBase:
+        return self.shards[zlib.crc32(key_bytes(key)) % len(self.shards)]
+
+    def _partition(self, keys) -> List[list]:
+        ret = [[] for _ in self.shards]
+        n = len(self.shards)
+        for key in keys:
+            ret[zlib.crc32(key_bytes(key)) % n].append(key)
+        return ret
+
+    def _close_db(self):
+        if hasattr(self, 'executor'):
+            self.executor.shutdown()
+            del self.executor
+        for shard in getattr(self, 'shards', []):
+            shard.close()
+
+    def _get_db(self, key: str) -> bytes:
+        return self._shard(key)._get_db(key)
+
+    def _get_db_many(self, keys: List[str]) -> List[bytes]:
+        found = {}
+        for shard, shard_keys in zip(self.shards, self._partition(set(keys))):
+            if shard_keys:
+                found.update(zip(shard_keys, shard._get_db_many(shard_keys)))
+        return [found[key] for key in keys]
+
+    def _set_db(self, key: str, value: bytes) -> None:
+        self._shard(key)._set_db(key, value)
+
+    def _del_db(self, key: str) -> None:
+        self._shard(key)._del_db(key)
+
+    def _set_db_batch(self, batch: KeySValueIterator) -> None:
+        batches = [[] for _ in self.shards]
+        n = len(self.shards)
+        for key, value in batch:
+            batches[zlib.crc32(key_bytes(key)) % n].append((key, value))
+        futures = [
+            self.executor.submit(shard._set_db_batch, shard_batch)
+            for shard, shard_batch in zip(self.shards, batches)
+            if shard_batch
+        ]
+        for future in futures:
+            future.result()
+
+    def _on_shards(self, name: str, *args) -> list:
+        futures = [self.executor.submit(getattr(shard, name), *args) for shard in self.shards]
+        return [future.result() for future in futures]
+
+    def _del_db_batch(self, keys: List[str]) -> None:
+        futures = [
+            self.executor.submit(shard._del_db_batch, shard_keys)
+            for shard, shard_keys in zip(self.shards, self._partition(keys))
+            if shard_keys
+        ]
+        for future in futures:
+            future.result()
+
+    def _del_db_range(self, start=None, stop=None) -> None:
+        self._on_shards('_del_db_range', start, stop)
+
+    def _clear_db(self) -> None:
+        self._on_shards('_clear_db')
+
+    def _count(self) -> int:
+        return sum(shard._count() for shard in self.shards)
+
+    def _keys(self, reverse=False, start=None, stop=None) -> Iterator[str]:
+        return heapq.merge(
+            *[shard._keys(reverse, start, stop) for shard in self.shards],
+            reverse=reverse
+        )
+
+    def _db_items(self, reverse=False, start=None, stop=None) -> KeySValueIterator:
+        return heapq.merge(
+            *[shard._db_items(reverse, start, stop) for shard in self.shards],
+            key=lambda item: item[0], reverse=reverse
+        )
+
+    def _instrument(self, metrics):
+        super()._instrument(metrics)
+        for shard in self.shards:
+            shard._instrument(metrics.prefixed('shards.'))
+
+    def _get_meta(self, name: str) -> bytes:
+        return self.shards[0]._get_meta(name)
+
+    def _set_meta(self, name: str, value: bytes) -> None:
+        self.shards[0]._set_meta(name, value)
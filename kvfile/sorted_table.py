@@ -0,0 +1,216 @@
+import bisect
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from typing import Dict, Iterator, Tuple
+
+from .bloom import BloomFilter
+
+# File layout:
+#   header
+#   values, in key order
+#   keys (utf8, or encoded by the key codec), in key order
+#   key offsets (count + 1, relative to the keys region)
+#   value offsets (count + 1, absolute)
+#   bloom filter (optional)
+#   metadata records
+# Offsets are little endian uint64, each section starts 8 byte aligned
+MAGIC = b'KVFSST01'
+HEADER = struct.Struct('<8s6Q')
+META_RECORD = struct.Struct('<II')
+ALIGNMENT = 8
+# Every FENCE_INTERVAL-th key is kept in memory, so that lookups only
+# binary search the mapping within a small block
+FENCE_INTERVAL = 16
+
+
+def _offsets_bytes(offsets: array) -> bytes:
+    if sys.byteorder != 'little':
+        offsets = array('Q', offsets)
+        offsets.byteswap()
+    return offsets.tobytes()
+
+
+def _offsets_view(view: memoryview, count: int):
+    offsets = view[:count * 8]
+    if sys.byteorder != 'little':
+        offsets = array('Q', offsets.tobytes())
+        offsets.byteswap()
+        return offsets
+    return offsets.cast('Q')
+
+
+def _pad(f, pos: int) -> int:
+    padding = -pos % ALIGNMENT
+    f.write(b'\0' * padding)
+    return pos + padding
+
+
+def write_sorted_table(filename, items: Iterator[Tuple[str, bytes]], meta: Dict[str, bytes]=None,
+                       bloom_error_rate=None):
+    """
+    Write (key, value) pairs, which must be sorted by key and unique,
+    into an immutable sorted table file.
+    The file is written next to `filename` and moved into place when done.
+    """
+    tmp_filename = filename + '.tmp'
+    key_offsets = array('Q', [0])
+    value_offsets = array('Q', [HEADER.size])
+    with open(tmp_filename, 'wb') as f, tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(filename))) as keys:
+        f.write(b'\0' * HEADER.size)
+        pos = HEADER.size
+        keys_size = 0
+        last_key = None
+        for key, value in items:
+            if key.__class__ is not bytes:
+                key = key.encode('utf8')
+            assert last_key is None or key > last_key, 'Keys must be sorted and unique'
+            last_key = key
+            f.write(value)
+            pos += len(value)
+            value_offsets.append(pos)
+            keys.write(key)
+            keys_size += len(key)
+            key_offsets.append(keys_size)
+        count = len(key_offsets) - 1
+
+        keys_offset = pos = _pad(f, pos)
+        keys.seek(0)
+        shutil.copyfileobj(keys, f)
+        pos += keys_size
+
+        key_index_offset = pos = _pad(f, pos)
+        f.write(_offsets_bytes(key_offsets))
+        value_index_offset = pos = pos + 8 * (count + 1)
+        f.write(_offsets_bytes(value_offsets))
+        pos += 8 * (count + 1)
+
+        bloom_offset = pos
+        if bloom_error_rate:
+            bloom = BloomFilter(count, bloom_error_rate)
+            keys.seek(0)
+            for i in range(count):
+                bloom.add(keys.read(key_offsets[i + 1] - key_offsets[i]))
+            bloom = bloom.to_bytes()
+            f.write(bloom)
+            pos += len(bloom)
+
+        meta_offset = pos
+        for name, value in (meta or {}).items():
+            name = name.encode('utf8')
+            f.write(META_RECORD.pack(len(name), len(value)))
+            f.write(name)
+            f.write(value)
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, count, keys_offset, key_index_offset, value_index_offset,
+                            bloom_offset, meta_offset))
+    os.replace(tmp_filename, filename)
+
+
+class SortedTable():
+    """
+    Read access to a sorted table file through a shared, read only mmap.
+    Keys are bytes, values are returned as memoryviews into the mapping.
+    keys() and items() return str keys, or bytes with `binary_keys`.
+    """
+
+    def __init__(self, filename, binary_keys=False):
+        self.binary_keys = binary_keys
+        with open(filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.keys_offset, key_index_offset, value_index_offset, bloom_offset, meta_offset = \
+            HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            self.mmap.close()
+            raise ValueError('{} is not a sorted table file'.format(filename))
+        self.view = memoryview(self.mmap)
+        self.key_offsets = _offsets_view(self.view[key_index_offset:], self.count + 1)
+        self.value_offsets = _offsets_view(self.view[value_index_offset:], self.count + 1)
+        self.fences = [self.key(i) for i in range(0, self.count, FENCE_INTERVAL)]
+        self.bloom = None
+        if meta_offset > bloom_offset:
+            self.bloom = BloomFilter.from_bytes(self.view[bloom_offset:meta_offset])
+        self.meta = {}
+        pos = meta_offset
+        while pos < len(self.mmap):
+            name_len, value_len = META_RECORD.unpack_from(self.mmap, pos)
+            pos += META_RECORD.size
+            name = self.mmap[pos:pos + name_len].decode('utf8')
+            self.meta[name] = self.mmap[pos + name_len:pos + name_len + value_len]
+            pos += name_len + value_len
+
+    def close(self):
+        self.key_offsets = self.value_offsets = self.bloom = self.fences = None
+        self.view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            # Values handed out are still alive, the mapping is released
+            # along with the last of them
+            pass
+
+    def key(self, i: int) -> bytes:
+        return self.mmap[self.keys_offset + self.key_offsets[i]:self.keys_offset + self.key_offsets[i + 1]]
+
+    def value(self, i: int) -> memoryview:
+        return self.view[self.value_offsets[i]:self.value_offsets[i + 1]]
+
+    def value_bytes(self, i: int) -> bytes:
+        return self.mmap[self.value_offsets[i]:self.value_offsets[i + 1]]
+
+    def bisect(self, key: bytes) -> int:
+        """Index of the first key >= key."""
+        data, offsets, base = self.mmap, self.key_offsets, self.keys_offset
+        block = bisect.bisect_left(self.fences, key)
+        if block == 0:
+            return 0
+        lo = (block - 1) * FENCE_INTERVAL + 1
+        hi = min(block * FENCE_INTERVAL, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[base + offsets[mid]:base + offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, key: bytes) -> int:
+        """Index of key, or -1 if it's not in the table."""
+        if self.bloom is not None and key not in self.bloom:
+            return -1
+        i = self.bisect(key)
+        if i < self.count and self.key(i) == key:
+            return i
+        return -1
+
+    def indexes(self, reverse=False, start: bytes=None, stop: bytes=None) -> range:
+        lo = 0 if start is None else self.bisect(start)
+        hi = self.count if stop is None else self.bisect(stop)
+        hi = max(lo, hi)
+        return range(hi - 1, lo - 1, -1) if reverse else range(lo, hi)
+
+    def keys(self, reverse=False, start: bytes=None, stop: bytes=None) -> Iterator[str]:
+        data, offsets, base = self.mmap, self.key_offsets, self.keys_offset
+        if self.binary_keys:
+            for i in self.indexes(reverse, start, stop):
+                yield data[base + offsets[i]:base + offsets[i + 1]]
+            return
+        for i in self.indexes(reverse, start, stop):
+            yield data[base + offsets[i]:base + offsets[i + 1]].decode('utf8')
+
+    def items(self, reverse=False, start: bytes=None, stop: bytes=None, views=False) -> Iterator[Tuple[str, bytes]]:
+        data, key_offsets, value_offsets, base = self.mmap, self.key_offsets, self.value_offsets, self.keys_offset
+        values = self.view if views else data
+        if self.binary_keys:
+            for i in self.indexes(reverse, start, stop):
+                yield data[base + key_offsets[i]:base + key_offsets[i + 1]], \
+                    values[value_offsets[i]:value_offsets[i + 1]]
+            return
+        for i in self.indexes(reverse, start, stop):
+            yield data[base + key_offsets[i]:base + key_offsets[i + 1]].decode('utf8'), \
+                values[value_offsets[i]:value_offsets[i + 1]]
@@ -22,6 +22,13 @@ INSTALL_REQUIRES = [
 SPEEDUP_REQUIRES = [
     'plyvel',
 ]
+FAST_JSON_REQUIRES = [
+    'orjson',
+]
+COMPRESSION_REQUIRES = [
+    'zstandard',
+    'lz4',
+]
 LINT_REQUIRES = [
     'pylama',
 ]
@@ -43,6 +50,8 @@ setup(
     extras_require={
         'develop': LINT_REQUIRES + TESTS_REQUIRE,
         'speedup': SPEEDUP_REQUIRES,
+        'compression': COMPRESSION_REQUIRES,
+        'fast-json': FAST_JSON_REQUIRES,
     },
     zip_safe=False,
     long_description=README,
@@ -1,12 +1,19 @@
 import datetime
+import os
 import decimal
+import math
 import pytest
+import cachetools
+from functools import partial
 from kvfile.kvfile_leveldb import KVFileLevelDB, CachedKVFileLevelDB
 from kvfile.kvfile_sqlite import KVFileSQLite, CachedKVFileSQLite
-from kvfile.serializer import PickleSerializer, JsonSerializer
+from kvfile.kvfile_log import KVFileLog, CachedKVFileLog
+from kvfile.hybrid import HybridKVFile
+from kvfile.key_codec import TypedKeyCodec
+from kvfile.serializer import PickleSerializer, JsonSerializer, FastJsonSerializer, CompressedSerializer
 
-@pytest.mark.parametrize('KVFile', [KVFileLevelDB, KVFileSQLite])
-@pytest.mark.parametrize('serializer', [PickleSerializer, JsonSerializer])
+@pytest.mark.parametrize('KVFile', [KVFileLevelDB, KVFileSQLite, KVFileLog])
+@pytest.mark.parametrize('serializer', [PickleSerializer, JsonSerializer, FastJsonSerializer])
 def test_sanity(KVFile, serializer):
 
     kv = KVFile(serializer())
@@ -33,7 +40,7 @@ def test_sanity(KVFile, serializer):
     assert list(kv.items(reverse=True)) == sorted(data.items(), reverse=True)
 
 
-@pytest.mark.parametrize('KVFile', [KVFileLevelDB, KVFileSQLite])
+@pytest.mark.parametrize('KVFile', [KVFileLevelDB, KVFileSQLite, KVFileLog])
 @pytest.mark.parametrize('serializer', [PickleSerializer, JsonSerializer])
 def test_insert(KVFile, serializer):
     kv = KVFile(serializer())
@@ -132,4 +139,875 @@ def test_default(KVFile, serializer):
     assert kv.get('bbbb', default=6) == 6
     with pytest.raises(KeyError):
         kv.get('bbbb')
-        
\ No newline at end of file
+        
+
+@pytest.mark.parametrize('max_write_batch_bytes', [1, 1024, KVFileLevelDB.MAX_WRITE_BATCH_BYTES])
+def test_leveldb_write_batch(max_write_batch_bytes):
+    kv = KVFileLevelDB(sync=True, max_write_batch_bytes=max_write_batch_bytes)
+    kv.insert(((str(i), ':{}'.format(i)) for i in range(5000)), batch_size=2000)
+    assert len(list(kv.items())) == 5000
+    assert kv.get('4999') == ':4999'
+
+
+@pytest.mark.parametrize('KVFile', [
+    KVFileLevelDB, KVFileSQLite, CachedKVFileLevelDB, CachedKVFileSQLite,
+    partial(CachedKVFileLevelDB, size=2), partial(CachedKVFileSQLite, size=2)
+])
+@pytest.mark.parametrize('reverse', [False, True])
+def test_ranges(KVFile, reverse):
+    kv = KVFile()
+    keys = ['a', 'ab', 'abc', 'abd', 'ac', 'b', 'b\U0010ffff', 'ba', 'c']
+    for key in keys:
+        kv.set(key, key.upper())
+
+    def expected(cond, limit=None):
+        ret = sorted((k for k in keys if cond(k)), reverse=reverse)
+        return ret[:limit] if limit is not None else ret
+
+    assert list(kv.keys(reverse=reverse, prefix='ab')) == expected(lambda k: k.startswith('ab'))
+    assert list(kv.keys(reverse=reverse, prefix='b')) == expected(lambda k: k.startswith('b'))
+    assert list(kv.keys(reverse=reverse, start='ab', stop='b')) == expected(lambda k: 'ab' <= k < 'b')
+    assert list(kv.keys(reverse=reverse, start='abd')) == expected(lambda k: k >= 'abd')
+    assert list(kv.keys(reverse=reverse, stop='abd', limit=2)) == expected(lambda k: k < 'abd', 2)
+    assert list(kv.keys(reverse=reverse, prefix='a', start='abd')) == \
+        expected(lambda k: k.startswith('a') and k >= 'abd')
+    assert list(kv.items(reverse=reverse, prefix='ab', limit=2)) == \
+        [(k, k.upper()) for k in expected(lambda k: k.startswith('ab'), 2)]
+    assert list(kv.items(reverse=reverse, prefix='x')) == []
+    # Ranges holding a single key
+    assert list(kv.keys(reverse=reverse, prefix='abc')) == ['abc']
+    assert list(kv.keys(reverse=reverse, prefix='c')) == ['c']
+    assert list(kv.items(reverse=reverse, start='ac', stop='b')) == [('ac', 'AC')]
+    assert list(kv.keys(reverse=reverse, start='a', stop='ab')) == ['a']
+
+
+@pytest.mark.parametrize('KVFile', [
+    KVFileLevelDB, KVFileSQLite, CachedKVFileLevelDB, CachedKVFileSQLite,
+    partial(CachedKVFileLevelDB, size=100), partial(CachedKVFileSQLite, size=100)
+])
+def test_get_many(KVFile):
+    kv = KVFile()
+    kv.insert(((str(i), ':{}'.format(i)) for i in range(2000)))
+    keys = [str(i) for i in range(1999, -1, -3)] + ['5', 'missing', '5']
+    expected = [':{}'.format(k) for k in keys[:-3]] + [':5', None, ':5']
+    assert kv.get_many(keys, default=None) == expected
+    assert kv.get_many([]) == []
+    with pytest.raises(KeyError):
+        kv.get_many(keys)
+
+
+@pytest.mark.parametrize('KVFile', [CachedKVFileLevelDB, CachedKVFileSQLite])
+@pytest.mark.parametrize('writeback_size', [1, 10, 1000])
+def test_cached_writeback(KVFile, writeback_size):
+    kv = KVFile(size=20, writeback_size=writeback_size)
+    for i in range(200):
+        kv.set('%03d' % i, i)
+    assert len(kv.pending) < writeback_size
+    for i in range(200):
+        assert kv.get('%03d' % i) == i
+    kv.set('000', 'updated')
+    kv.delete('001')
+    assert kv.get('000') == 'updated'
+    assert kv.get('001', default=None) is None
+    assert kv.get_many(['000', '001', '199'], default=None) == ['updated', None, 199]
+    pending = len(kv.pending)
+    assert list(kv.keys(limit=3)) == ['000', '002', '003']
+    # Scans merge unwritten values instead of flushing them
+    assert len(kv.pending) == pending
+    kv.flush()
+    assert len(kv.pending) == 0
+
+
+def test_sqlite_migration(tmpdir):
+    import sqlite3
+    location = str(tmpdir.join('db'))
+    conn = sqlite3.connect(location + '.sqlite')
+    conn.execute('CREATE TABLE d (key text PRIMARY KEY, value blob)')
+    conn.execute('CREATE UNIQUE INDEX i ON d (key)')
+    conn.executemany('INSERT INTO d VALUES (?, ?)',
+                     ((str(i), PickleSerializer().serialize(i)) for i in range(100)))
+    conn.commit()
+    conn.close()
+
+    kv = KVFileSQLite(location=location)
+    assert kv.get('42') == 42
+    assert len(list(kv.keys())) == 100
+    assert len(kv) == 100
+    schema = kv.cursor.execute("SELECT type, name, sql FROM sqlite_master WHERE tbl_name='d'").fetchall()
+    assert [(t, n) for t, n, _ in schema] == [('table', 'd')]
+    assert 'WITHOUT ROWID' in schema[0][2]
+    kv.close()
+
+
+def test_sqlite_count_keys(tmpdir):
+    location = str(tmpdir.join('db'))
+    kv = KVFileSQLite(location=location)
+    kv.insert(('%04d' % i, i) for i in range(100))
+    kv.close()
+    kv = KVFileSQLite(location=location, count_keys=True)
+    triggers = kv.cursor.execute("SELECT name FROM sqlite_master WHERE type='trigger'").fetchall()
+    assert triggers == [('d_insert',), ('d_delete',)]
+    kv.set('x', 1)
+    kv.delete('0001')
+    assert len(kv) == 100 and kv._get_meta(kv.COUNT_META) == 100
+    kv.close()
+    # Writers without count_keys drop the triggers and the count
+    kv = KVFileSQLite(location=location)
+    assert kv.cursor.execute("SELECT name FROM sqlite_master WHERE type='trigger'").fetchall() == []
+    assert kv._get_meta(kv.COUNT_META) is None
+    kv.set('y', 1)
+    assert len(kv) == 101
+    kv.close()
+
+
+@pytest.mark.parametrize('journal_mode', ['WAL', 'DELETE'])
+def test_sqlite_pragmas(tmpdir, journal_mode):
+    location = str(tmpdir.join('db'))
+    kv = KVFileSQLite(location=location, journal_mode=journal_mode, synchronous='OFF',
+                      cache_size=-2000, mmap_size=1 << 20, page_size=8192)
+    assert kv.cursor.execute('PRAGMA journal_mode').fetchone()[0].upper() == journal_mode
+    assert kv.cursor.execute('PRAGMA page_size').fetchone()[0] == 8192
+    kv.insert(((str(i), i) for i in range(5000)), batch_size=700)
+    kv.set('x', 'y')
+    kv.close()
+    kv = KVFileSQLite(location=location)
+    assert kv.get('x') == 'y'
+    assert len(list(kv.items())) == 5001
+    kv.close()
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'lzma', 'zstd', 'lz4'])
+@pytest.mark.parametrize('serializer', [PickleSerializer, JsonSerializer])
+def test_compressed_serializer(codec, serializer):
+    import pickle
+    from kvfile.serializer_compressed import zstandard, lz4
+    if (codec == 'zstd' and zstandard is None) or (codec == 'lz4' and lz4 is None):
+        pytest.skip('{} is not installed'.format(codec))
+    compressed = CompressedSerializer(serializer(), codec=codec, threshold=64)
+    small = dict(a=1)
+    large = dict(a=['value'] * 100, n=decimal.Decimal('1234.56'))
+    assert compressed.serialize(small)[0] == 0
+    assert compressed.serialize(large)[0] != 0
+    assert len(compressed.serialize(large)) < len(serializer().serialize(large))
+
+    kv = KVFileLevelDB(compressed)
+    kv.set('small', small)
+    kv.set('large', large)
+    assert kv.get('small') == small
+    assert kv.get('large') == large
+
+    # Values written with one codec can be read with another
+    other = CompressedSerializer(serializer(), codec='zlib')
+    assert other.deserialize(compressed.serialize(large)) == large
+    assert pickle.loads(pickle.dumps(compressed)).deserialize(compressed.serialize(large)) == large
+
+
+@pytest.mark.parametrize('KVFile', [KVFileLevelDB, KVFileSQLite, CachedKVFileLevelDB, CachedKVFileSQLite, KVFileLog])
+@pytest.mark.parametrize('codec', ['zlib', 'zstd'])
+def test_compression_dictionary(tmpdir, KVFile, codec):
+    from kvfile.serializer_compressed import zstandard
+    if codec == 'zstd' and zstandard is None:
+        pytest.skip('zstd is not installed')
+    location = str(tmpdir.join('db'))
+    data = [('%05d' % i, dict(id=i, name='item %d' % i, kind='record', tags=['a', 'b', 'c']))
+            for i in range(1000)]
+    serializer = CompressedSerializer(JsonSerializer(), codec=codec, threshold=16)
+    kv = KVFile(serializer, location=location, dictionary_samples=200)
+    kv.insert(iter(data))
+    assert kv.serializer.dictionary is not None
+    assert len(kv._get_db('00500')) < len(JsonSerializer().serialize(data[500][1]))
+    assert list(kv.items()) == data
+    kv.close()
+
+    kv = KVFile(CompressedSerializer(JsonSerializer(), codec=codec), location=location)
+    assert kv.get('00999') == data[999][1]
+    assert list(kv.items()) == data
+    kv.close()
+
+    kv = KVFile(JsonSerializer(), location=location, dictionary_samples=200)
+    kv.insert([('x', data[0][1])])
+    assert kv.get('00001') == data[1][1]
+    assert kv.get('x') == data[0][1]
+    kv.close()
+
+
+@pytest.mark.parametrize('use_orjson', [False, True])
+@pytest.mark.parametrize('sort_keys', [False, True])
+def test_fast_json_serializer(use_orjson, sort_keys):
+    from kvfile.serializer_json import orjson
+    if use_orjson and orjson is None:
+        pytest.skip('orjson is not installed')
+    data = dict(
+        t=datetime.time(12, 30, 15),
+        d=datetime.date(2020, 2, 29),
+        dt=datetime.datetime(2020, 2, 29, 12, 30, 15),
+        p=datetime.timedelta(days=1, seconds=5),
+        n=decimal.Decimal('1234.56'),
+        ss={1, 2, 3},
+        big=2 ** 70,
+        l=[dict(n=decimal.Decimal('1.5'))],
+        bad={'type{date}': 'not a date'},
+        inf=[float('inf'), float('-inf')],
+        none=None,
+        z='value',
+    )
+    fast = FastJsonSerializer(sort_keys=sort_keys, use_orjson=use_orjson)
+    assert math.isnan(fast.deserialize(fast.serialize(dict(nan=float('nan'))))['nan'])
+    assert math.isnan(fast.deserialize(fast.serialize([None, {float('nan')}]))[1].pop())
+    assert fast.deserialize(fast.serialize(data)) == data
+    assert fast.deserialize(JsonSerializer().serialize(data)) == data
+    assert JsonSerializer().deserialize(fast.serialize(data)) == data
+    keys = list(fast.deserialize(fast.serialize(data)).keys())
+    assert keys == (sorted(data.keys()) if sort_keys else list(data.keys()))
+
+
+@pytest.mark.parametrize('KVFile', [KVFileLevelDB, partial(CachedKVFileSQLite, size=100)])
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+@pytest.mark.parametrize('serializer', [PickleSerializer, JsonSerializer])
+def test_parallel_items(KVFile, executor, serializer):
+    kv = KVFile(serializer())
+    data = [('%05d' % i, dict(i=i, n=decimal.Decimal(i))) for i in range(5000)]
+    kv.insert(iter(data))
+    assert list(kv.items(workers=3, chunk_size=100, executor=executor)) == data
+    assert list(kv.items(reverse=True, workers=2, chunk_size=7, executor=executor)) == data[::-1]
+    assert list(kv.items(prefix='010', limit=5, workers=2, executor=executor)) == data[1000:1005]
+    partial_scan = kv.items(workers=2, chunk_size=10, executor=executor)
+    assert next(partial_scan) == data[0]
+    partial_scan.close()
+
+
+@pytest.mark.parametrize('KVFile', [
+    KVFileLevelDB, KVFileSQLite, CachedKVFileLevelDB, partial(CachedKVFileSQLite, size=100)
+])
+@pytest.mark.parametrize('batch_size', [1, 1000])
+def test_raw(KVFile, batch_size):
+    src = KVFile(JsonSerializer())
+    src.insert(((str(i), ':{}'.format(i)) for i in range(500)))
+    assert src.get_raw('42') == b'":42"'
+    assert src.get_raw('x', default=None) is None
+    with pytest.raises(KeyError):
+        src.get_raw('x')
+    assert list(src.items_raw(prefix='49', limit=2)) == [('49', b'":49"'), ('490', b'":490"')]
+
+    dst = KVFile(JsonSerializer())
+    dst.insert_raw(src.items_raw(), batch_size=batch_size)
+    dst.set_raw('x', b'{"a": 1}')
+    assert dst.get('x') == dict(a=1)
+    assert list(dst.items(stop='x')) == list(src.items())
+
+
+@pytest.mark.parametrize('KVFile', [KVFileLevelDB, KVFileSQLite, partial(CachedKVFileSQLite, size=100)])
+@pytest.mark.parametrize('memory_limit', [1, 10000, KVFileLevelDB.DEFAULT_SORT_MEMORY_LIMIT])
+def test_presort(KVFile, memory_limit):
+    from random import shuffle
+    data = [('%05d' % i, i) for i in range(3000)]
+    shuffled = data[:]
+    shuffle(shuffled)
+    # Duplicates: the last written value wins
+    old = [(k, 'old') for k, _ in data[:100]]
+    shuffle(old)
+    shuffled += old + [(k, 'new') for k, _ in data[:50]]
+    kv = KVFile()
+    returned = list(kv.insert_generator(iter(shuffled), presort=True, memory_limit=memory_limit))
+    assert returned == shuffled
+    expected = [(k, 'new') for k, _ in data[:50]] + [(k, 'old') for k, _ in data[50:100]] + data[100:]
+    assert list(kv.items()) == expected
+    assert not [name for name in os.listdir(kv._scratch_dir()) if name.startswith('kvfile-sort-')]
+
+
+@pytest.mark.parametrize('KVFile', [KVFileSQLite, partial(CachedKVFileLevelDB, size=100), CachedKVFileSQLite])
+def test_async(KVFile):
+    import asyncio
+    from kvfile.aio import AsyncKVFile
+
+    async def main():
+        async with AsyncKVFile(KVFile()) as kv:
+            await asyncio.gather(*[kv.set('%03d' % i, i) for i in range(300)])
+            assert await kv.get('005') == 5
+            assert await kv.get('xxx', default=None) is None
+            with pytest.raises(KeyError):
+                await kv.get('xxx')
+            values = await asyncio.gather(*[kv.get('%03d' % i) for i in range(300)])
+            assert values == list(range(300))
+            assert await kv.get_many(['001', 'xxx', '001'], default=-1) == [1, -1, 1]
+            await kv.delete('001')
+            await kv.set('002', 'two')
+            assert await kv.get_many(['001', '002'], default=None) == [None, 'two']
+            assert [key async for key in kv.keys(limit=3)] == ['000', '002', '003']
+            items = [item async for item in kv.items(prefix='29')]
+            assert items == [('29%d' % i, 290 + i) for i in range(10)]
+            return kv
+    kv = asyncio.run(main())
+    assert kv.kv.closed
+
+
+@pytest.mark.parametrize('KVFile', [
+    partial(KVFileSQLite, thread_safe=True),
+    partial(CachedKVFileSQLite, thread_safe=True, size=50, writeback_size=10),
+    partial(CachedKVFileLevelDB, thread_safe=True, size=50, writeback_size=10),
+])
+def test_thread_safe(KVFile):
+    from concurrent.futures import ThreadPoolExecutor
+    kv = KVFile()
+    kv.insert(('r%04d' % i, i) for i in range(1000))
+
+    def worker(n):
+        for i in range(300):
+            kv.set('w%d-%04d' % (n, i), i)
+            assert kv.get('r%04d' % ((i * 7 + n) % 1000)) == (i * 7 + n) % 1000
+            assert kv.get('w%d-%04d' % (n, i // 2)) == i // 2
+            if i % 100 == 0 and hasattr(kv, 'flush'):
+                kv.flush()
+        return n
+
+    with ThreadPoolExecutor(8) as pool:
+        assert sorted(pool.map(worker, range(8))) == list(range(8))
+    assert len(list(kv.keys(prefix='w'))) == 8 * 300
+    assert kv.get_many(['w7-0299', 'r0999']) == [299, 999]
+    kv.close()
+
+
+def _read_shared(args):
+    KVFile, location = args
+    kv = KVFile(location=location, readonly=True)
+    ret = kv.get('0042'), len(list(kv.keys()))
+    kv.close()
+    return ret
+
+
+@pytest.mark.parametrize('KVFile', [
+    KVFileLevelDB, KVFileSQLite, CachedKVFileLevelDB, CachedKVFileSQLite, partial(KVFileSQLite, immutable=True),
+    KVFileLog
+])
+def test_readonly(tmpdir, KVFile):
+    import multiprocessing
+    location = str(tmpdir.join('db'))
+    kv = KVFile(location=location)
+    kv.insert(('%04d' % i, i) for i in range(1000))
+    kv.close()
+
+    readers = [KVFile(location=location, readonly=True) for _ in range(3)]
+    for reader in readers:
+        assert reader.get('0999') == 999
+        assert list(reader.keys(prefix='000')) == ['%04d' % i for i in range(10)]
+        for write in (lambda: reader.set('x', 1), lambda: reader.delete('0001'),
+                      lambda: reader.insert([('x', 1)]), lambda: reader.set_raw('x', b'')):
+            with pytest.raises(PermissionError):
+                write()
+    with multiprocessing.Pool(3) as pool:
+        assert pool.map(_read_shared, [(KVFile, location)] * 3) == [(42, 1000)] * 3
+    for reader in readers:
+        reader.close()
+    if KVFile is KVFileLevelDB:
+        assert os.listdir(str(tmpdir)) == ['db']
+
+    kv = KVFile(location=location)
+    kv.set('x', 1)
+    assert kv.get('x') == 1
+    kv.close()
+
+
+@pytest.mark.parametrize('kvfile_cls', [KVFileLevelDB, KVFileSQLite])
+@pytest.mark.parametrize('reverse', [False, True])
+def test_sharded(tmpdir, kvfile_cls, reverse):
+    from kvfile.sharded import ShardedKVFile
+    location = str(tmpdir.join('sharded'))
+    kv = ShardedKVFile(kvfile_cls, location=location, shards=3)
+    data = [('%05d' % i, i) for i in range(3000)]
+    kv.insert(iter(data[::-1]), batch_size=500)
+    kv.set('x', 'x')
+    kv.delete('x')
+    assert all(len(list(shard.keys())) > 500 for shard in kv.shards)
+    assert list(kv.items(reverse=reverse)) == sorted(data, reverse=reverse)
+    assert list(kv.keys(reverse=reverse, prefix='012', limit=3)) == \
+        sorted(['%05d' % i for i in range(1200, 1300)], reverse=reverse)[:3]
+    assert kv.get_many(['00007', 'x', '02999'], default=None) == [7, None, 2999]
+    kv.close()
+
+    with pytest.raises(ValueError):
+        ShardedKVFile(kvfile_cls, location=location, shards=4)
+    kv = ShardedKVFile(kvfile_cls, location=location, shards=3, readonly=True)
+    assert kv.get('01234') == 1234
+    kv.close()
+
+
+def test_sharded_cached():
+    from kvfile.cached import CachedKVFile
+    from kvfile.sharded import ShardedKVFile
+    kv = CachedKVFile(partial(ShardedKVFile, shards=2), size=10, dictionary_samples=10)
+    kv.insert(('%03d' % i, dict(i=i)) for i in range(100))
+    assert list(kv.keys(limit=2)) == ['000', '001']
+    assert kv.get('099') == dict(i=99)
+
+
+@pytest.mark.parametrize('KVFile', [KVFileLevelDB, KVFileSQLite, partial(CachedKVFileLevelDB, size=10)])
+@pytest.mark.parametrize('bloom_error_rate', [None, 0.01])
+def test_sorted_table(tmpdir, KVFile, bloom_error_rate):
+    from kvfile.kvfile_sorted import KVFileSortedTable
+    src = KVFile(JsonSerializer(), dictionary_samples=50)
+    data = [('%04d' % i, dict(i=i, s='value %d' % i)) for i in range(2000)]
+    src.insert(iter(data))
+    src.set('א', 'unicode')
+    location = str(tmpdir.join('table.kvst'))
+    src.export(location, bloom_error_rate=bloom_error_rate)
+
+    # The compression dictionary is exported along with the data
+    kv = KVFileSortedTable(CompressedSerializer(JsonSerializer()), location=location)
+    assert kv.get('0042') == dict(i=42, s='value 42')
+    assert kv.get('א') == 'unicode'
+    assert kv.get('0042x', default=None) is None
+    with pytest.raises(KeyError):
+        kv.get('x')
+    raw = kv.get_raw('0042')
+    assert isinstance(raw, memoryview) and bytes(raw) == src.get_raw('0042')
+    assert kv.get_many(['0001', 'x', '1999'], default=None) == \
+        [dict(i=1, s='value 1'), None, dict(i=1999, s='value 1999')]
+    assert list(kv.items()) == list(src.items())
+    assert list(kv.keys(reverse=True, prefix='00', limit=3)) == ['0099', '0098', '0097']
+    assert list(kv.keys(start='1998')) == ['1998', '1999', 'א']
+    assert list(kv.keys(start='5', stop='6')) == []
+    assert [(k, bytes(v)) for k, v in kv.items_raw(prefix='199')] == list(src.items_raw(prefix='199'))
+    assert list(kv.items(prefix='001', workers=2, executor='thread')) == data[10:20]
+    with pytest.raises(PermissionError):
+        kv.set('x', 1)
+    kv.close()
+
+    empty = KVFileLevelDB()
+    empty.export(location)
+    kv = KVFileSortedTable(location=location)
+    assert list(kv.items()) == []
+    assert kv.get('x', default=None) is None
+    kv.close()
+
+
+@pytest.mark.parametrize('KVFile', [CachedKVFileLevelDB, CachedKVFileSQLite])
+def test_cached_bloom(tmpdir, KVFile, monkeypatch):
+    location = str(tmpdir.join('db'))
+    kv = KVFile(location=location, size=10)
+    kv.insert(('%04d' % i, i) for i in range(1000))
+    kv.close()
+
+    monkeypatch.setattr(KVFile, 'DEFAULT_BLOOM_CAPACITY', 100)
+    kv = KVFile(location=location, size=10, bloom_error_rate=0.01)
+    assert kv.get('0500') == 500
+    assert kv.get_many(['0001', 'x'], default=None) == [1, None]
+    misses = ['%04dx' % i for i in range(1000)]
+    assert kv.get_many(misses, default=None) == [None] * 1000
+    assert all(kv.get(key, default=None) is None for key in misses)
+    stats = kv.bloom_stats()
+    assert stats['negatives'] + stats['false_positives'] == 2001
+    assert stats['false_positives'] < 100
+
+    # Keys written after opening, including past the filter's capacity
+    kv.insert(('new%04d' % i, i) for i in range(2000))
+    kv.set('x', 'x')
+    assert kv.get('x') == 'x'
+    assert kv.get_many(['new0000', 'new1999'], default=None) == [0, 1999]
+    assert kv.bloom_capacity >= 2 * 2000
+    kv.delete('x')
+    assert kv.get('x', default=None) is None
+    kv.rebuild_bloom()
+    assert kv.get('0999') == 999
+    assert kv.get('new1000') == 1000
+    kv.close()
+
+
+@pytest.mark.parametrize('policy', ['lru', 'lfu', '2q', 'ttl'])
+@pytest.mark.parametrize('max_bytes', [None, 2000])
+def test_cache_policies(policy, max_bytes):
+    import time
+    kv = CachedKVFileSQLite(size=50, writeback_size=7, policy=policy, max_bytes=max_bytes, ttl=0.2)
+    data = [('%04d' % i, 'v' * (i % 50)) for i in range(1000)]
+    for key, value in data:
+        kv.set(key, value)
+        kv.get(data[0][0])
+    # Larger than the whole cache
+    kv.set('big', 'x' * 5000)
+    assert kv.get('big') == 'x' * 5000
+    if max_bytes:
+        assert kv.cache.currsize <= max_bytes
+        assert 'big' not in kv.cache
+    else:
+        assert len(kv.cache) <= 50
+    if policy == 'ttl':
+        time.sleep(0.3)
+    assert kv.get('0010') == data[10][1]
+    assert list(kv.items()) == sorted(data + [('big', 'x' * 5000)])
+    kv.delete('0011')
+    assert kv.get('0011', default=None) is None
+    kv.close()
+
+
+def test_ttl_expiring_during_get(monkeypatch):
+    from kvfile.cached import CachedKVFile, DBWriteOnEvictionTTLCache
+    now = [0]
+
+    def clock():
+        # Every reading moves the clock forward
+        now[0] += 1
+        return now[0]
+    monkeypatch.setitem(CachedKVFile.CACHE_POLICIES, 'ttl', partial(DBWriteOnEvictionTTLCache, timer=clock))
+    # Dirty entries expire at every step of the lookups for some ttl
+    for ttl in range(1, 10):
+        kv = CachedKVFileSQLite(policy='ttl', ttl=ttl)
+        kv.set('a', 1)
+        kv.set('b', 2)
+        assert kv.get('a', default=None) == 1
+        assert kv.get_many(['b', 'a']) == [2, 1]
+        kv.close()
+
+
+@pytest.mark.parametrize('policy', ['lru', 'ttl'])
+def test_cached_garbage_collected(tmpdir, policy):
+    import gc
+    import time
+    location = str(tmpdir.join('db'))
+    kv = CachedKVFileSQLite(location=location, size=10, writeback_size=5, policy=policy, ttl=0.05)
+    for i in range(20):
+        kv.set('%04d' % i, i)
+    # Closed by the garbage collector, expired entries are written back then
+    kv.cycle = kv
+    time.sleep(0.1)
+    del kv
+    gc.collect()
+    kv = KVFileSQLite(location=location)
+    assert dict(kv.items()) == {'%04d' % i: i for i in range(20)}
+    kv.close()
+
+
+def test_ttl_delete_range(monkeypatch):
+    import time
+    import kvfile.cached
+    kv = CachedKVFileSQLite(size=50, writeback_size=7, policy='ttl', ttl=0.1)
+    data = [('%04d' % i, i) for i in range(20)]
+    kv.insert(data)
+
+    # Entries expire after the range is listed, before they are dropped
+    def slow_in_range(key, start, stop, in_range=kvfile.cached.in_range):
+        if key == data[-1][0]:
+            time.sleep(0.2)
+        return in_range(key, start, stop)
+    monkeypatch.setattr(kvfile.cached, 'in_range', slow_in_range)
+    kv.delete_range(start='0005', stop='0015')
+    monkeypatch.undo()
+    assert list(kv.items()) == data[:5] + data[15:]
+    assert len(kv) == 10
+    kv.close()
+
+
+def test_2q_scan_resistance():
+    from kvfile.cached import TwoQCache
+
+    def access(cache, key):
+        if key not in cache:
+            cache[key] = key
+
+    hot = ['hot%d' % i for i in range(50)]
+    cold = ('cold%d' % i for i in range(100000))
+    lru, twoq = cachetools.LRUCache(100), TwoQCache(100)
+    for cache in (lru, twoq):
+        for _ in range(5):
+            for key in hot:
+                access(cache, key)
+            for _ in range(40):
+                access(cache, next(cold))
+        # A long scan goes through the FIFO queue only
+        for _ in range(10000):
+            access(cache, next(cold))
+    assert not any(key in lru for key in hot)
+    assert all(key in twoq for key in hot)
+    assert len(twoq) == 100
+
+
+@pytest.mark.parametrize('KVFile', [CachedKVFileLevelDB, CachedKVFileSQLite])
+@pytest.mark.parametrize('reverse', [False, True])
+def test_cached_scan(KVFile, reverse):
+    kv = KVFile(size=100, writeback_size=50)
+    data = {'%04d' % i: i for i in range(1000)}
+    kv.insert(data.items())
+    kv.flush()
+    # Dirty values, some only in the cache, some pending, shadowing older ones
+    for i in range(0, 1000, 7):
+        data['%04d' % i] = 'new%d' % i
+        kv.set('%04d' % i, 'new%d' % i)
+    for key in ('0000x', '0500x', 'zzz'):
+        data[key] = key
+        kv.set(key, key)
+    kv.delete('0003')
+    del data['0003']
+    assert kv.dirty and kv.pending
+    dirty, pending = set(kv.dirty), dict(kv.pending)
+    lru = list(kv.cache.keys())
+
+    assert list(kv.items(reverse=reverse)) == sorted(data.items(), reverse=reverse)
+    assert list(kv.keys(reverse=reverse)) == sorted(data, reverse=reverse)
+    assert list(kv.items(reverse=reverse, prefix='050')) == \
+        sorted((k, v) for k, v in data.items() if k.startswith('050'))[::-1 if reverse else 1]
+    assert list(kv.keys(reverse=reverse, start='0990', stop='0995')) == \
+        sorted(['0990', '0991', '0992', '0993', '0994'], reverse=reverse)
+    # Nothing was flushed or promoted in the cache
+    assert kv.dirty == dirty and kv.pending == pending
+    assert list(kv.cache.keys()) == lru
+    kv.close()
+
+
+@pytest.mark.parametrize('KVFile', [KVFileLevelDB, KVFileSQLite, CachedKVFileLevelDB, CachedKVFileSQLite])
+def test_metrics(KVFile):
+    import weakref
+    kv = KVFile(**(dict(size=10, writeback_size=5) if KVFile.__name__.startswith('Cached') else {}))
+    assert kv.stats().get('counters') is None
+    events = []
+    kv.enable_metrics(lambda name, value: events.append((name, value)))
+    kv.insert((('%03d' % i, i) for i in range(100)), batch_size=20)
+    kv.set('x', 'x')
+    assert kv.get('x') == 'x'
+    assert kv.get_many(['000', 'y'], default=None) == [0, None]
+    kv.delete('x')
+    assert list(kv.items(prefix='01', workers=2, executor='process')) == [('%03d' % i, i) for i in range(10, 20)]
+
+    stats = kv.stats()
+    latencies = stats['latencies']
+    assert latencies['set_db_batch']['count'] == 5
+    assert latencies['set']['count'] == latencies['get']['count'] == latencies['delete']['count'] == 1
+    assert latencies['serialize']['count'] == 101
+    assert sum(latencies['get']['buckets'].values()) == 1
+    assert stats['counters']['serialize.bytes'] > 0
+    if 'cache' in stats:
+        counters = stats['counters']
+        assert counters['cache.hits'] == 1 and counters['cache.misses'] == 2
+        # The value read back for '000' evicts a clean entry
+        assert counters['cache.evictions'] == 92
+        assert counters['cache.writebacks'] == 90 and counters['cache.flushes'] == 18
+        assert stats['cache']['size'] == 9 and stats['cache']['dirty'] == 8
+        assert latencies['backend.set_db_batch']['count'] == counters['cache.flushes']
+    if isinstance(kv, KVFileSQLite):
+        assert stats['counters']['commits'] > 0
+    assert ('set', latencies['set']['sum']) in events
+    # Metrics don't keep the store alive
+    ref = weakref.ref(kv)
+    del kv
+    assert ref() is None
+
+
+def sharded(location=None, **kw):
+    from kvfile.sharded import ShardedKVFile
+    return ShardedKVFile(KVFileSQLite, location=location, shards=3, **kw)
+
+
+@pytest.mark.parametrize('KVFile', [
+    KVFileLevelDB, KVFileSQLite, partial(KVFileLevelDB, count_keys=True), partial(KVFileSQLite, count_keys=True),
+    partial(CachedKVFileLevelDB, size=100, writeback_size=50, count_keys=True),
+    partial(CachedKVFileSQLite, size=100, bloom_error_rate=0.01), sharded, partial(KVFileLog, max_segment_bytes=4096)
+])
+def test_count_and_bulk_delete(tmpdir, KVFile):
+    location = str(tmpdir.join('db'))
+    kv = KVFile(location=location)
+    assert len(kv) == 0
+    kv.insert(('%04d' % i, i) for i in range(1000))
+    # Overwrites, duplicates in a batch and deletes of missing keys don't change the count
+    kv.insert([('0001', 'x'), ('a', 1), ('a', 2)])
+    kv.set('0002', 'y')
+    kv.delete('nope')
+    assert len(kv) == 1001
+
+    kv.delete_many(['0003', '0004', '0003', 'nope'])
+    kv.delete_range(start='0100', stop='0200')
+    kv.delete_range(prefix='09')
+    data = {'%04d' % i: i for i in range(1000) if not 100 <= i < 200 and i < 900 and i not in (3, 4)}
+    data.update({'0001': 'x', '0002': 'y', 'a': 2})
+    assert len(kv) == len(data)
+    assert dict(kv.items()) == data
+    assert kv.get('0150', default=None) is None
+    kv.close()
+
+    kv = KVFile(location=location)
+    assert len(kv) == len(data)
+    kv.clear()
+    assert len(kv) == 0 and list(kv.keys()) == []
+    assert kv.get('0005', default=None) is None
+    kv.set('b', 1)
+    assert len(kv) == 1 and dict(kv.items()) == {'b': 1}
+    kv.close()
+
+
+def test_sqlite_without_upsert(tmpdir, monkeypatch):
+    # SQLite versions older than 3.24
+    monkeypatch.setattr(KVFileSQLite, 'HAS_UPSERT', False)
+    kv = KVFileSQLite(location=str(tmpdir.join('db')))
+    kv.insert(('%04d' % i, i) for i in range(100))
+    kv.insert([('0001', 'x'), ('a', 1), ('a', 2)])
+    kv.set('0002', 'y')
+    kv.set('b', 3)
+    data = {'%04d' % i: i for i in range(100)}
+    data.update({'0001': 'x', '0002': 'y', 'a': 2, 'b': 3})
+    assert dict(kv.items()) == data
+    assert len(kv) == len(data)
+    kv.close()
+
+
+def test_leveldb_count_recovery(tmpdir):
+    location = str(tmpdir.join('db'))
+    kv = KVFileLevelDB(location=location)
+    kv.insert(('%04d' % i, i) for i in range(100))
+    assert len(kv) == 100
+    kv.close()
+    kv = KVFileLevelDB(location=location, count_keys=True)
+    kv.set('x', 1)
+    assert len(kv) == 101
+    kv.close()
+    # The saved count is used until the first write
+    kv = KVFileLevelDB(location=location)
+    assert kv.count_saved and len(kv) == 101
+    kv.set('y', 1)
+    assert not kv.count_saved and len(kv) == 102
+    kv.close()
+    kv = KVFileLevelDB(location=location, count_keys=True)
+    kv.set('z', 1)
+    assert len(kv) == 103
+    # Not closed properly: the count is recomputed when reopened
+    kv.db.close()
+    kv.closed = True
+    kv = KVFileLevelDB(location=location, count_keys=True)
+    assert kv.count_saved is False and len(kv) == 103
+    kv.close()
+
+
+def test_log(tmpdir):
+    from kvfile import open_kvfile
+    location = str(tmpdir.join('db'))
+    kv = KVFileLog(location=location, max_segment_bytes=10000, compaction_threshold=0.9)
+    data = {'%04d' % i: i for i in range(1000)}
+    kv.insert(data.items())
+    for i in range(0, 1000, 3):
+        data['%04d' % i] = 'new%d' % i
+        kv.set('%04d' % i, 'new%d' % i)
+    kv.delete_many(['%04d' % i for i in range(0, 1000, 5)])
+    for i in range(0, 1000, 5):
+        del data['%04d' % i]
+    assert len(os.listdir(location)) > 2
+    assert kv.get_many(['0001', '0003', '0005'], default=None) == [1, 'new3', None]
+    assert list(kv.items(reverse=True, start='0100', stop='0200')) == \
+        sorted(((k, v) for k, v in data.items() if '0100' <= k < '0200'), reverse=True)
+    kv.close()
+
+    # Reopened from the hint files
+    kv = KVFileLog(location=location, max_segment_bytes=10000)
+    assert dict(kv.items()) == data
+    dead = 1 - kv.live_bytes / kv.total_bytes
+    assert dead > 0.3
+    kv.compact()
+    assert len(kv) == len(data) and dict(kv.items()) == data
+    assert 1 - kv.live_bytes / kv.total_bytes < 0.01
+    # Not closed properly: the last segment has no hint file, and a torn record
+    kv.set('x', 'x')
+    data['x'] = 'x'
+    kv.active.flush()
+    with open(kv._path(kv.active_id, 'data'), 'ab') as f:
+        f.write(b'\0' * 10)
+    kv.closed = True
+    kv = KVFileLog(location=location)
+    assert kv.get('x') == 'x' and len(kv) == len(data)
+    kv.close()
+
+    # Overwriting enough of the store compacts it automatically
+    kv = KVFileLog(location=location, max_segment_bytes=10000)
+    size = sum(os.path.getsize(os.path.join(location, name)) for name in os.listdir(location))
+    for _ in range(10):
+        kv.insert(data.items())
+    assert sum(os.path.getsize(os.path.join(location, name)) for name in os.listdir(location)) < 3 * size
+    assert dict(kv.items()) == data
+    kv.close()
+
+    kv = open_kvfile('log', location=location)
+    assert isinstance(kv, CachedKVFileLog) and kv.get('0001') == 1
+    kv.close()
+    with pytest.raises(ValueError):
+        open_kvfile('nope')
+
+
+def test_hybrid(tmpdir):
+    from kvfile import open_kvfile
+    kv = HybridKVFile(CachedKVFileSQLite, max_bytes=30000, dictionary_samples=10,
+                      serializer=CompressedSerializer(PickleSerializer()))
+    data = {'%04d' % i: 'value %d' % i for i in range(100)}
+    kv.insert(data.items())
+    kv.delete('0001')
+    del data['0001']
+    assert kv.backend is None and kv.filename is None and kv._scratch_dir() is None
+    assert len(kv) == len(data)
+    assert list(kv.items(reverse=True, start='0010', stop='0020')) == \
+        sorted(((k, v) for k, v in data.items() if '0010' <= k < '0020'), reverse=True)
+    # Past the budget everything moves to the backend, including the compression dictionary
+    data.update(('%04d' % i, 'value %d' % i) for i in range(100, 1000))
+    kv.insert(data.items())
+    assert isinstance(kv.backend, CachedKVFileSQLite) and kv.data is None
+    assert kv._get_meta(kv.DICTIONARY_META) is not None
+    assert len(kv) == len(data) and dict(kv.items()) == data
+    assert kv.get('0001', default=None) is None
+    kv.close()
+
+    # Stores with a location are opened in the backend right away
+    location = str(tmpdir.join('db'))
+    kv = open_kvfile('sqlite', max_memory=10000, location=location)
+    kv.set('a', 1)
+    kv.close()
+    kv = CachedKVFileSQLite(location=location)
+    assert kv.get('a') == 1
+    kv.close()
+
+
+@pytest.mark.parametrize('KVFile', [
+    KVFileLevelDB, KVFileSQLite, partial(KVFileLog, max_segment_bytes=4096),
+    partial(CachedKVFileLevelDB, size=100, writeback_size=50),
+    partial(CachedKVFileSQLite, size=100, bloom_error_rate=0.01),
+    sharded, partial(HybridKVFile, CachedKVFileSQLite, max_bytes=30000),
+])
+def test_typed_keys(tmpdir, KVFile):
+    from kvfile.kvfile_sorted import KVFileSortedTable
+    location = str(tmpdir.join('db')) if KVFile.__class__ is not partial or KVFile.func is not HybridKVFile else None
+    kv = KVFile(location=location, key_codec=TypedKeyCodec())
+    keys = [i for i in range(-300, 300, 3)] + [('a', i) for i in range(100)] + [('a', -1, 'x'), ('b\xff', None)] + \
+        [datetime.datetime(2020, 1, 1) + datetime.timedelta(hours=i) for i in range(100)] + \
+        ['s', 's\x00', 'st', b'\x00\xff', (), 2 ** 100, (b'\x01', 1), (b'\x01\x00\x07', 1), ('a\x00', 1)]
+    kv.insert(((key, str(key)) for key in reversed(keys)), batch_size=7)
+    kv.set(0, 'zero')
+    kv.delete(('a', 5))
+    keys.remove(('a', 5))
+    data = {key: str(key) for key in keys}
+    data[0] = 'zero'
+    assert len(kv) == len(data)
+    assert kv.get(3) == '3' and kv.get(4, default=None) is None and kv.get_many([0, ('a', 1)]) == ['zero', "('a', 1)"]
+    # Integers in numeric order, tuples element by element
+    assert list(kv.keys(start=-10, stop=10)) == [-9, -6, -3, 0, 3, 6, 9]
+    assert list(kv.keys(prefix=('a',), limit=3)) == [('a', -1, 'x'), ('a', 0), ('a', 1)]
+    assert list(kv.keys(prefix='s')) == ['s', 's\x00', 'st']
+    # Elements containing 0x00 bytes
+    assert list(kv.keys(prefix=(b'\x01',))) == [(b'\x01', 1)]
+    assert list(kv.keys(prefix=('a\x00',))) == [('a\x00', 1)]
+    assert ('a\x00', 1) not in list(kv.keys(prefix=('a',)))
+    assert list(kv.items(reverse=True, start=datetime.datetime(2020, 1, 4), limit=2)) == \
+        [(key, str(key)) for key in (datetime.datetime(2020, 1, 5, 3), datetime.datetime(2020, 1, 5, 2))]
+    assert dict(kv.items()) == data
+    kv.delete_range(start=0, stop=300)
+    kv.delete_many([('a', i) for i in range(50)])
+    data = {key: value for key, value in data.items()
+            if not (isinstance(key, int) and 0 <= key < 300) and not (isinstance(key, tuple) and key[:1] == ('a',) and
+                                                                     len(key) == 2 and key[1] < 50)}
+    # Presorted with spilled runs
+    kv.insert(((('p', i), i) for i in reversed(range(50))), presort=True, memory_limit=1000)
+    assert list(kv.keys(prefix=('p',))) == [('p', i) for i in range(50)]
+    kv.delete_range(prefix=('p',))
+    # Keys of different types sort by type
+    assert list(kv.keys()) == sorted(data, key=TypedKeyCodec().encode)
+    if location is None:
+        return
+    kv.close()
+
+    kv = KVFile(location=location, key_codec=TypedKeyCodec())
+    assert dict(kv.items()) == data
+    kv.export(str(tmpdir.join('table')))
+    kv.close()
+    table = KVFileSortedTable(location=str(tmpdir.join('table')), key_codec=TypedKeyCodec())
+    assert table.get(-3) == '-3' and list(table.keys(prefix=('a',), limit=1)) == [('a', -1, 'x')]
+    assert [key for key, _ in table.items_raw(start=-6, stop=0)] == [-6, -3]
+    table.close()